@@ -0,0 +1,46 @@
+import threading
+import traceback
+
+
+class Autosaver(object):
+    """Writes game snapshots on a background thread so saving never stalls the main loop.
+
+    Only the newest snapshot matters: if a new one arrives while the previous one is still waiting to be
+    written, the older one is dropped."""
+
+    def __init__(self, write, filename):
+        self.write = write
+        self.filename = filename
+        self.pending = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, snapshot):
+        # Queue a snapshot to be written, returns immediately
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def close(self):
+        # Write whatever is still pending and stop the thread. Safe to call more than once
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                snapshot, self.pending = self.pending, None
+            try:
+                self.write(snapshot, self.filename)
+            except Exception:
+                # a failed autosave leaves the previous savegame in place, keep playing
+                traceback.print_exc()
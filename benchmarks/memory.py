@@ -0,0 +1,78 @@
+"""How many bytes the objects of a level take, with the game classes in __slots__ and as they would be with a
+__dict__ per instance.
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m benchmarks.memory
+
+Only the instances themselves are counted (sys.getsizeof), the values in their fields are the same either way.
+The __dict__ size is what an instance of a plain class plus a dict of the same fields takes."""
+import collections
+import sys
+
+import libtcodpy as libtcod
+import main
+from headless import ScriptedInput
+
+SEED = 1
+LEVELS = (1, 5, 10)
+
+
+class Plain(object):
+    pass
+
+
+def dict_size(obj):
+    # The instance as it was before __slots__: a small object and a dict of it's fields
+    fields = {}
+    for cls in obj.__class__.__mro__:
+        for field in getattr(cls, '__slots__', ()):
+            if hasattr(obj, field):
+                fields[field] = getattr(obj, field)
+    return sys.getsizeof(Plain()) + sys.getsizeof(fields)
+
+
+def level_instances():
+    # Every object of the level, it's components and effects, and the rooms
+    instances = list(main.rooms)
+    for obj in main.all_entities():
+        instances.append(obj)
+        for component in (obj.fighter, obj.ai, obj.item, obj.equipment, obj.container, obj.controller):
+            if component:
+                instances.append(component)
+        if isinstance(obj.ai, main.ConfusedMonster) and obj.ai.old_ai:
+            instances.append(obj.ai.old_ai)
+        if obj.fighter:
+            instances.extend(obj.fighter.active_effects)
+    return instances
+
+
+def measure_level(level):
+    # {class name: [count, bytes with slots, bytes with a dict]} for the given dungeon level
+    main.dungeon_lvl = level
+    main.build_level()
+    sizes = collections.OrderedDict()
+    for instance in level_instances():
+        row = sizes.setdefault(instance.__class__.__name__, [0, 0, 0])
+        row[0] += 1
+        row[1] += sys.getsizeof(instance)
+        row[2] += dict_size(instance)
+    return sizes
+
+
+def run():
+    main.init_headless(ScriptedInput())
+    main.mouse = libtcod.Mouse()
+    main.new_game(SEED)
+    print('%-16s %8s %12s %12s' % ('level / class', 'count', 'slots', 'dict'))
+    for level in LEVELS:
+        sizes = measure_level(level)
+        for name, (count, slotted, plain) in sizes.items():
+            print('%-16s %8d %12d %12d' % ('  ' + name, count, slotted, plain))
+        totals = [sum(row[i] for row in sizes.values()) for i in range(3)]
+        print('%-16s %8d %12d %12d  (%.0f%% less)' % ('level %d' % level, totals[0], totals[1], totals[2],
+                                                      100.0 - 100.0 * totals[1] / max(totals[2], 1)))
+
+
+if __name__ == '__main__':
+    run()
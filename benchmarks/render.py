@@ -0,0 +1,51 @@
+"""Compare the per-tile and the NumPy map renderers.
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m benchmarks.render
+"""
+import time
+
+import libtcodpy as libtcod
+import main
+from constants import *
+from headless import ScriptedInput
+
+FRAMES = 200
+
+
+def full_repaint_time(renderer, frames):
+    # Time a full map repaint, the worst case for both renderers
+    main.map_renderer = renderer
+    main.init_fov()
+    main.compute_fov()
+    start = time.time()
+    for i in range(frames):
+        main.mark_all_dirty()
+        main.update_visible_tiles(main.fov_tiles)
+        main.render_map()
+    return (time.time() - start) / frames
+
+
+def map_backgrounds():
+    return [tuple(main.color_rgb(libtcod.console_get_char_background(main.con, x, y)))
+            for y in range(VIEW_HEIGHT) for x in range(VIEW_WIDTH)]
+
+
+def run():
+    main.init_headless(ScriptedInput())  # off-screen consoles, no window
+    main.new_game(1)
+
+    tiles_time = full_repaint_time('tiles', FRAMES)
+    tiles_pixels = map_backgrounds()
+    numpy_time = full_repaint_time('numpy', FRAMES)
+    numpy_pixels = map_backgrounds()
+
+    print('tiles: %.3f ms/frame' % (tiles_time * 1000))
+    print('numpy: %.3f ms/frame' % (numpy_time * 1000))
+    print('speedup: %.1fx' % (tiles_time / numpy_time))
+    print('identical pixels: %s' % (tiles_pixels == numpy_pixels))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,320 @@
+"""The benchmark suite: map generation, FOV, chasing monsters, rendering and savegames, all from fixed seeds.
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m benchmarks.run                    # run everything and compare with the baseline, if there is one
+    python -m benchmarks.run fov render_all     # only the benchmarks whose names start with these
+    python -m benchmarks.run --save-baseline    # store the results as the new baseline
+    python -m benchmarks.run --all              # also run the renderer, savegame format and memory comparisons
+
+Every benchmark reports operations per second and, on python 3, the peak memory python allocated during one
+operation (tracemalloc, memory libtcod allocates itself is not seen). With a baseline a benchmark more than
+--tolerance percent slower than it was is flagged, and the exit status is 1. Timings only compare on the same
+machine, so the baseline is not part of the repository: save one before making changes."""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import libtcodpy as libtcod
+import main
+from constants import *
+from headless import ScriptedInput
+from profiler import clock
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+SEED = 1
+LEVELS = (1, 5, 10)
+MONSTER_COUNTS = (10, 50)
+BIG_MAP_ROOMS = 5000  # room attempts on the 1000x1000 map
+MIN_SECONDS = 0.5  # time every benchmark for at least this long...
+MIN_ROUNDS = 5  # ...and at least this many operations
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# (name, setup) in the order they run. setup() prepares the game and returns the operation to time
+BENCHMARKS = []
+
+# Scratch directory for savegames, made by run()
+scratch = None
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def new_game(level=1):
+    # A fresh game from the fixed seed, on the given dungeon level
+    main.init_headless(ScriptedInput())
+    main.mouse = libtcod.Mouse()
+    main.new_game(SEED)
+    if level != 1:
+        main.dungeon_lvl = level
+        main.build_level()
+
+
+def add_monsters(count):
+    # Put count orcs on the free floor tiles farthest from the player, returns [(monster, x, y)]
+    player = main.player
+    floor = [(x, y) for y in range(MAP_HEIGHT) for x in range(MAP_WIDTH) if not main.is_blocked(x, y)]
+    floor.sort(key=lambda position: (-player.distance(*position), position))
+    monsters = []
+    for (x, y) in floor[:count]:
+        fighter = main.Fighter(hp=20, defense=0, power=0, xp=0, death_function=main.monster_death)
+        monster = main.Object(x, y, 'o', 'orc', libtcod.desaturated_green, blocks=True, fighter=fighter,
+                              ai=main.BasicMonster(), controller=main.Controller())
+        main.objects.append(monster)
+        monsters.append((monster, x, y))
+    return monsters
+
+
+def make_map_benchmark(level, generate):
+    def setup():
+        new_game()
+        main.dungeon_lvl = level
+        seed = main.level_seed(level)
+
+        def operation():
+            main.seed_streams(seed, ('mapgen', 'spawn', 'loot'))
+            generate()
+        return operation
+    return setup
+
+
+def chase_benchmark(count, step):
+    def setup():
+        new_game()
+        monsters = add_monsters(count)
+
+        def operation():
+            # everyone back to the start, then one step towards the player
+            for (monster, x, y) in monsters:
+                monster.x = x
+                monster.y = y
+            for (monster, x, y) in monsters:
+                step(monster)
+        return operation
+    return setup
+
+
+def path_to(monster):
+    monster.controller.path_to(main.player.x, main.player.y)
+
+
+def chase(monster):
+    main.chase_origin = None  # as if the player had moved, so the shared chase map is computed every time
+    monster.controller.chase(main.player)
+
+
+for level in LEVELS:
+    benchmark('make_map/level-%d' % level)(make_map_benchmark(level, main.make_map))
+for level in LEVELS:
+    benchmark('bsp_make_map/level-%d' % level)(make_map_benchmark(level, main.bsp_make_map))
+benchmark('make_map/1000x1000')(make_map_benchmark(1, lambda: main.make_map(1000, 1000, BIG_MAP_ROOMS)))
+
+
+@benchmark('place_objects/1000x1000')
+def place_objects_big_map():
+    # Only the monsters and items of the big map, into the rooms make_map dug out
+    new_game()
+    seed = main.level_seed(1)
+    main.seed_streams(seed, ('mapgen', 'spawn', 'loot'))
+    main.make_map(1000, 1000, BIG_MAP_ROOMS)
+    rooms = main.rooms[1:]
+
+    def operation():
+        main.seed_streams(seed, ('spawn', 'loot'))
+        main.objects = main.ObjectList([main.player])
+        floor_items = []
+        for room in rooms:
+            main.place_objects(room, floor_items)
+        main.objects.extend_front(floor_items)
+    return operation
+
+
+@benchmark('fov/init_fov')
+def init_fov():
+    new_game()
+    return main.init_fov
+
+
+@benchmark('fov/compute')
+def compute_fov():
+    new_game()
+
+    def operation():
+        main.fov_cache.clear()
+        main.compute_fov()
+    return operation
+
+
+@benchmark('fov/compute-cached')
+def compute_fov_cached():
+    new_game()
+    main.compute_fov()
+    return main.compute_fov
+
+
+for count in MONSTER_COUNTS:
+    benchmark('path_to/%d-monsters' % count)(chase_benchmark(count, path_to))
+for count in MONSTER_COUNTS:
+    benchmark('chase/%d-monsters' % count)(chase_benchmark(count, chase))
+
+
+@benchmark('render_all/full')
+def render_all_full():
+    new_game()
+
+    def operation():
+        main.fov_recompute = True
+        main.mark_all_dirty()
+        main.render_all()
+    return operation
+
+
+@benchmark('render_all/unchanged')
+def render_all_unchanged():
+    new_game()
+    main.render_all()
+    return main.render_all
+
+
+@benchmark('render_all/1000x1000-scrolling')
+def render_all_scrolling():
+    # A frame after the player jumped to another room of a big map: new active area, FOV and camera position
+    new_game()
+    main.seed_streams(main.level_seed(1), ('mapgen', 'spawn', 'loot'))
+    main.make_map(1000, 1000, BIG_MAP_ROOMS)
+    main.init_fov()
+    centers = [room.center() for room in main.rooms]
+    state = {'next': 0}
+
+    def operation():
+        main.player.x, main.player.y = centers[state['next'] % len(centers)]
+        state['next'] += 1
+        main.fov_recompute = True
+        main.render_all()
+    return operation
+
+
+@benchmark('levels/down-and-up')
+def levels_down_and_up():
+    # Page the level out and the one below in, then back: after the first round both come from the level store
+    new_game()
+
+    def operation():
+        main.player.x, main.player.y = main.stairs.x, main.stairs.y
+        main.next_level()
+        main.player.x, main.player.y = main.upstairs.x, main.upstairs.y
+        main.previous_level()
+    return operation
+
+
+@benchmark('savegame/save')
+def save_game():
+    new_game(5)
+    filename = os.path.join(scratch, 'savegame')
+    return lambda: main.save_game(filename)
+
+
+@benchmark('savegame/load')
+def load_game():
+    new_game(5)
+    filename = os.path.join(scratch, 'savegame')
+    main.save_game(filename)
+    return lambda: main.load_game(filename)
+
+
+def measure(operation):
+    operation()  # warm up
+    rounds = 0
+    start = clock()
+    while True:
+        operation()
+        rounds += 1
+        elapsed = clock() - start
+        if elapsed >= MIN_SECONDS and rounds >= MIN_ROUNDS:
+            break
+    result = {'ops_per_sec': rounds / elapsed, 'peak_kib': None}
+    if tracemalloc:
+        tracemalloc.start()
+        operation()
+        result['peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    return result
+
+
+def run(prefixes=()):
+    global scratch
+    scratch = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, setup in BENCHMARKS:
+            if not prefixes or any(name.startswith(prefix) for prefix in prefixes):
+                results[name] = measure(setup())
+    finally:
+        shutil.rmtree(scratch)
+    return results
+
+
+def report(results, baseline, tolerance):
+    # Print the results next to the baseline, returns the names of the benchmarks that got slower
+    slower = []
+    print('%-28s %12s %10s %10s' % ('benchmark', 'ops/sec', 'peak KiB', 'baseline'))
+    for name, setup in BENCHMARKS:
+        if name not in results:
+            continue
+        result = results[name]
+        peak = '%10.1f' % result['peak_kib'] if result['peak_kib'] is not None else '%10s' % '-'
+        change = ''
+        if name in baseline:
+            percent = (result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1) * 100
+            change = '%+9.1f%%' % percent
+            if percent < -tolerance:
+                change += ' slower'
+                slower.append(name)
+        print('%-28s %12.1f %s %s' % (name, result['ops_per_sec'], peak, change))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('prefixes', nargs='*', help='only run the benchmarks whose names start with these')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file to compare with or save to')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='percent slower that counts as slower')
+    parser.add_argument('--all', action='store_true', help='also run the render, savegame and memory comparisons')
+    args = parser.parse_args()
+
+    results = run(args.prefixes)
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    slower = report(results, baseline, args.tolerance)
+    if not baseline and not args.save_baseline:
+        print('no baseline in %s to compare with, store one with --save-baseline' % args.baseline)
+    if args.save_baseline:
+        # keep the baseline of benchmarks that were not run this time
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print('baseline saved to ' + args.baseline)
+
+    if args.all:
+        from benchmarks import memory, render, savegame
+        render.run()
+        savegame.run()
+        memory.run()
+    sys.exit(1 if slower else 0)
@@ -0,0 +1,99 @@
+"""Compare the binary savegame format with the old shelve (pickle) savegames, and check the round trip.
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m benchmarks.savegame
+"""
+import os
+import shelve
+import shutil
+import tempfile
+import time
+
+import main
+from headless import ScriptedInput
+from worldmap import PLANES
+
+ROUNDS = 50
+
+
+def shelve_save(filename):
+    # The pre-binary-format save_game()
+    f = shelve.open(filename, 'n')
+    f['map'] = main.world_map
+    f['objects'] = main.objects
+    f['player_index'] = main.objects.index(main.player)
+    f['game_msgs'] = main.game_msgs
+    f['game_state'] = main.game_state
+    f['stairs_index'] = main.objects.index(main.stairs)
+    f['dungeon_lvl'] = main.dungeon_lvl
+    f.close()
+
+
+def shelve_load(filename):
+    f = shelve.open(filename, 'r')
+    state = [f[key] for key in ('map', 'objects', 'player_index', 'game_msgs', 'game_state', 'stairs_index',
+                                'dungeon_lvl')]
+    f.close()
+    return state
+
+
+def file_size(filename):
+    # shelve may add an extension to the name, depending on the dbm module in use
+    directory, name = os.path.split(filename)
+    return sum(os.path.getsize(os.path.join(directory, other)) for other in os.listdir(directory)
+               if other.startswith(name))
+
+
+def timed(function, *args):
+    start = time.time()
+    for i in range(ROUNDS):
+        function(*args)
+    return (time.time() - start) / ROUNDS
+
+
+def game_summary():
+    # Everything that has to survive a save and load, the round trip tests compare it too
+    entities = []
+    for obj in main.all_entities():
+        fighter = obj.fighter and (obj.fighter.hp, obj.fighter.max_hp, obj.fighter.power, obj.fighter.defense,
+                                   obj.fighter.death_function, len(obj.fighter.active_effects))
+        entities.append((obj.name, obj.x, obj.y, obj.char, (obj.color.r, obj.color.g, obj.color.b), obj.blocks,
+                         fighter, obj.ai.__class__.__name__, obj.item and obj.item.use_function,
+                         obj.equipment and obj.equipment.is_equipped))
+    return (main.game_seed, main.dungeon_lvl, main.game_state, main.game_msgs, main.objects.index(main.player),
+            main.objects.index(main.stairs), main.upstairs and main.objects.index(main.upstairs),
+            [(room.x1, room.y1, room.x2, room.y2) for room in main.rooms],
+            [bytes(main.world_map.plane(plane)) for plane in PLANES], entities)
+
+
+def run():
+    main.init_headless(ScriptedInput('wasdqezc', repeat=True))
+    main.new_game(1)
+    main.play_headless(main.input_source, 200)
+
+    directory = tempfile.mkdtemp()
+    try:
+        binary_name = os.path.join(directory, 'binary')
+        shelve_name = os.path.join(directory, 'shelve')
+
+        before = game_summary()
+        main.save_game(binary_name)
+        main.load_game(binary_name)
+        print('round trip identical: %s' % (game_summary() == before))
+
+        binary_save = timed(main.save_game, binary_name)
+        binary_load = timed(main.load_game, binary_name)
+        shelve_save_time = timed(shelve_save, shelve_name)
+        shelve_load_time = timed(shelve_load, shelve_name)
+
+        print('%-8s %10s %10s %10s' % ('format', 'bytes', 'save ms', 'load ms'))
+        print('%-8s %10d %10.2f %10.2f' % ('binary', file_size(binary_name), binary_save * 1000, binary_load * 1000))
+        print('%-8s %10d %10.2f %10.2f' % ('shelve', file_size(shelve_name), shelve_save_time * 1000,
+                                           shelve_load_time * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    run()
@@ -9,9 +9,18 @@ SCREEN_WIDTH = 80
 SCREEN_HEIGHT = 50
 LIMIT_FPS = 20
 
-# Size of the map
-MAP_WIDTH = SCREEN_WIDTH 
-MAP_HEIGHT = SCREEN_HEIGHT - 7 
+# Size of the map view, the part of the map on screen. The camera keeps the player in view
+VIEW_WIDTH = SCREEN_WIDTH
+VIEW_HEIGHT = SCREEN_HEIGHT - 7
+
+# Size of the map, which can be larger than the view
+MAP_WIDTH = VIEW_WIDTH
+MAP_HEIGHT = VIEW_HEIGHT
+
+# Maps are stored in square chunks of CHUNK_SIZE tiles a side, allocated when something in them changes. FOV and
+# pathfinding only cover the chunks up to ACTIVE_CHUNKS away from the one the player is in
+CHUNK_SIZE = 32
+ACTIVE_CHUNKS = 1
 
 # Some colors we use
 color_dark_wall = libtcod.darker_grey
@@ -20,6 +29,9 @@ color_light_wall = libtcod.dark_grey
 color_dark_floor = libtcod.sepia
 color_light_floor = libtcod.light_sepia
 
+# Map renderer: 'tiles' paints one tile at a time, 'numpy' fills the whole background in one call
+MAP_RENDERER = 'tiles'
+
 # Constants for room generation
 
 ROOM_MAX_SIZE = 10
@@ -31,6 +43,7 @@ MAX_ROOMS = 30
 FOV_ALGO = 0
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
+FOV_CACHE_SIZE = 64  # fields of view remembered per level
 
 # GUI Constants
 BAR_WIDTH = 20
@@ -43,10 +56,13 @@ INVENTORY_WIDTH = 50
 LEVEL_SCREEN_WIDTH = 43
 CHARACTER_SCREEN_WIDTH = 50
 
+# Monsters and items are defined in MONSTER_CONFIG, the parsed definitions are cached in MONSTER_CACHE
+
+MONSTER_CONFIG = 'monsters.config'
+MONSTER_CACHE = 'monsters.cache'
+
 # Effect constants
 
-HEAL_AMOUNT = 40
-BIG_HEAL_AMOUNT = 80
 LIGHTNING_RANGE = 4
 LIGHTNING_DAMAGE = 10
 CONFUSE_NUM_TURNS = 10
@@ -54,6 +70,40 @@ CONFUSE_RANGE = 8
 FIREBALL_RADIUS = 3
 FIREBALL_DAMAGE = 12
 
+# Turn scheduling: an action at normal speed takes ACTION_TIME, an object with twice the speed acts twice as often
+
+NORMAL_SPEED = 100
+ACTION_TIME = 100
+
+# Idle monsters farther than SLEEP_RADIUS from the player fall asleep, and wake up when the player gets within
+# WAKE_RADIUS of their room (anything the player can see has to be awake)
+
+SLEEP_RADIUS = 2 * TORCH_RADIUS
+WAKE_RADIUS = TORCH_RADIUS
+
+# Generate the next level in a worker process while the current one is played
+
+PREGENERATE_LEVELS = True
+
+# Record every input of a game into the file 'recording', so it can be replayed with replay.py
+
+RECORD_INPUT = True
+
+# Profile every frame from the start of a game (otherwise press 'p' to start), keeping the last PROFILE_WINDOW
+# frames. The statistics are written to PROFILE_FILE (.json or .csv) when the game is left
+
+PROFILE = False
+PROFILE_WINDOW = 1000
+PROFILE_FILE = 'profile.json'
+
+# Autosave every this many player turns (and on every new level)
+
+AUTOSAVE_INTERVAL = 100
+
+# Levels the player left are kept in a memory-mapped file next to the savegame, the savegame name plus this
+
+LEVEL_STORE_SUFFIX = '.levels'
+
 # Leveling constants
 
 LEVEL_UP_BASE = 200
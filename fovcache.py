@@ -0,0 +1,31 @@
+import collections
+
+
+class FovCache(object):
+    """Remembers the last few fields of view computed, least recently used ones are forgotten first.
+
+    Keys are whatever decides the outcome of an FOV computation (position, radius, map version), values are the
+    tiles it found in FOV."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        tiles = self.entries.pop(key, None)
+        if tiles is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = tiles  # most recently used again
+        return tiles
+
+    def put(self, key, tiles):
+        self.entries[key] = tiles
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,78 @@
+"""Run the game logic without a window, driven by scripted input.
+
+    python headless.py --keys wwwddd --turns 1000
+
+plays a new game with the given keys repeated until the game ends or the turn limit is reached."""
+import argparse
+import time
+
+import libtcodpy as libtcod
+import main
+
+
+class ScriptedInput(object):
+    """Stands in for the keyboard and mouse in headless runs.
+
+    Keys are fed to handle_keys() one per turn, menus pick the first option and targeting is cancelled.
+    Subclass it to make smarter decisions."""
+
+    def __init__(self, keys='', repeat=False):
+        self.keys = keys
+        self.repeat = repeat
+        self.position = 0
+
+    def next_key(self):
+        # Return the next key character, or None when the script is over
+        if self.position >= len(self.keys):
+            if not self.repeat or not self.keys:
+                return None
+            self.position = 0
+        char = self.keys[self.position]
+        self.position += 1
+        return char
+
+    def fill_key(self, key):
+        # Fill a libtcod.Key like sys_check_for_event would, returns False when there is no more input
+        char = self.next_key()
+        if char is None:
+            return False
+        set_key(key, char)
+        return True
+
+    def choose(self, header, options):
+        # Answer a menu, None closes it
+        if options:
+            return 0
+        return None
+
+    def choose_tile(self, max_range):
+        # Answer target_tile(), (None, None) cancels
+        return None, None
+
+
+def set_key(key, char):
+    key.vk = libtcod.KEY_ESCAPE if char == '\x1b' else libtcod.KEY_CHAR
+    key.c = ord(char)
+    key.pressed = True
+    key.lalt = False
+
+
+def run(source, max_turns=None, seed=None):
+    # Start a new game and play it headless, returns (turns played, seconds taken)
+    main.init_headless(source)
+    main.new_game(seed)
+    start = time.time()
+    turns = main.play_headless(source, max_turns)
+    return turns, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play a game without a window.')
+    parser.add_argument('--keys', default='wasdqezc', help='keys to press, repeated until the game ends')
+    parser.add_argument('--turns', type=int, default=1000, help='maximum number of player turns')
+    parser.add_argument('--seed', type=int, help='game seed, random if not given')
+    args = parser.parse_args()
+
+    turns, seconds = run(ScriptedInput(args.keys, repeat=True), args.turns, args.seed)
+    print('%d turns in %.2f s (%.0f turns/s), dungeon level %d, %s' % (
+        turns, seconds, turns / max(seconds, 1e-9), main.dungeon_lvl, main.game_state))
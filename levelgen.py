@@ -0,0 +1,31 @@
+import multiprocessing
+
+
+class LevelPipeline(object):
+    """Generates upcoming levels in a worker process while the current one is being played.
+
+    generate(dungeon_lvl, seed) runs in the worker and returns the level packed into bytes. A level is only
+    handed out for the exact level and seed it was requested with, anything else is thrown away."""
+
+    def __init__(self, generate):
+        self.generate = generate
+        self.pool = multiprocessing.Pool(1)
+        self.pending = {}  # (dungeon_lvl, seed) -> async result
+
+    def request(self, dungeon_lvl, seed):
+        # Start generating a level in the background, returns immediately
+        key = (dungeon_lvl, seed)
+        if key not in self.pending:
+            self.pending[key] = self.pool.apply_async(self.generate, key)
+
+    def take(self, dungeon_lvl, seed):
+        # The packed level if the worker has finished it, otherwise None and the caller makes it itself
+        result = self.pending.pop((dungeon_lvl, seed), None)
+        self.pending.clear()
+        if result is None or not result.ready() or not result.successful():
+            return None
+        return result.get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
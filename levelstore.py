@@ -0,0 +1,185 @@
+"""Visited dungeon levels, paged out to one memory-mapped file.
+
+The file starts with a header (magic, format version and the seed of the game it belongs to) followed by one
+record per level. A record has a small header of it's own (dungeon level, capacity, length) and then the level:
+the size of it's map, every allocated chunk of the map with it's planes as raw bytes, and the objects of the level
+as savegame bytes. When a level is paged back in the planes are sliced straight out of the mapping, there is
+nothing to decode, only the objects go through the savegame reader.
+
+Only the level being played is kept in python objects, the others are pages of the file the OS can drop whenever
+it likes. A level written again goes back into it's old record when it fits, so the file only grows with new
+levels, and flush() only writes out the records changed since the last flush."""
+import mmap
+import os
+import struct
+import tempfile
+
+from worldmap import PLANES, WorldMap
+
+MAGIC = b'RLLS'
+VERSION = 1
+INITIAL_SIZE = 1 << 16
+
+HEADER = struct.Struct('<4sHI')  # magic, version, game seed
+RECORD = struct.Struct('<III')  # dungeon level (0 for a free record), capacity, length
+LEVEL = struct.Struct('<IIIBI')  # map width, height, chunk size, default blocked, number of chunks
+CHUNK = struct.Struct('<ii')  # chunk x, chunk y
+FREE = 0
+
+
+class LevelStore(object):
+    """The levels of one game, by dungeon level.
+
+    Without a filename the levels go to an anonymous temporary file, which still keeps them out of memory.
+    An existing file is only kept if it belongs to a game with the same seed and reset is False."""
+
+    def __init__(self, filename=None, seed=0, reset=False):
+        self.filename = filename
+        self.seed = seed
+        self.records = {}  # dungeon level -> (offset, capacity)
+        self.free = []  # (offset, capacity) of records levels moved out of
+        self.end = HEADER.size  # where the next new record goes
+        self.dirty = []  # (offset, length) of the parts of the file written since the last flush
+        if filename is None:
+            self.file = tempfile.TemporaryFile()
+        else:
+            self.file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+        self.map = None
+        if reset or not self._scan():
+            self._start()
+
+    def __contains__(self, level):
+        return level in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def _map_file(self, size):
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def _start(self):
+        # An empty store for this game
+        self.records = {}
+        self.free = []
+        self.end = HEADER.size
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.truncate(0)  # nothing of an old store may be left in the unused end
+        self._map_file(INITIAL_SIZE)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.seed)
+        self.dirty = [(0, HEADER.size)]
+
+    def _scan(self):
+        # Find the records of an existing file, False if it isn't a store of this game
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            return False
+        self._map_file(size)
+        if HEADER.unpack_from(self.map, 0) != (MAGIC, VERSION, self.seed):
+            return False
+        offset = HEADER.size
+        while offset + RECORD.size <= size:
+            level, capacity, length = RECORD.unpack_from(self.map, offset)
+            if capacity == 0:
+                break  # the unused (zero) end of the file
+            if level == FREE:
+                self.free.append((offset, capacity))
+            else:
+                self.records[level] = (offset, capacity)
+            offset += RECORD.size + capacity
+        self.end = offset
+        return True
+
+    def _allocate(self, level, length):
+        # The offset of a record for the level that holds length bytes, it's old one if it is big enough
+        record = self.records.pop(level, None)
+        if record is not None:
+            if record[1] >= length:
+                self.records[level] = record
+                return record[0]
+            self._release(record)
+        for record in self.free:
+            if record[1] >= length:
+                self.free.remove(record)
+                self.records[level] = record
+                return record[0]
+        # a new record at the end, with some room for the level to grow (new chunks explored)
+        capacity = length + length // 4
+        offset = self.end
+        if offset + RECORD.size + capacity > len(self.map):
+            self._map_file(max(2 * len(self.map), offset + RECORD.size + capacity))
+        self.end = offset + RECORD.size + capacity
+        self.records[level] = (offset, capacity)
+        return offset
+
+    def _release(self, record):
+        offset, capacity = record
+        RECORD.pack_into(self.map, offset, FREE, capacity, 0)
+        self.dirty.append((offset, RECORD.size))
+        self.free.append(record)
+
+    def put(self, level, world_map, objects):
+        # Store the map and the objects (savegame bytes) of a level, replacing what was stored for it before
+        size = world_map.chunk_size * world_map.chunk_size
+        chunks = sorted(world_map.chunks.items())
+        length = LEVEL.size + len(chunks) * (CHUNK.size + len(PLANES) * size) + len(objects)
+        offset = self._allocate(level, length)
+        RECORD.pack_into(self.map, offset, level, self.records[level][1], length)
+        position = offset + RECORD.size
+        LEVEL.pack_into(self.map, position, world_map.width, world_map.height, world_map.chunk_size,
+                        world_map.defaults['blocked'], len(chunks))
+        position += LEVEL.size
+        for (cx, cy), chunk in chunks:
+            CHUNK.pack_into(self.map, position, cx, cy)
+            position += CHUNK.size
+            for plane in PLANES:
+                self.map[position:position + size] = bytes(getattr(chunk, plane))
+                position += size
+        self.map[position:position + len(objects)] = bytes(objects)
+        self.dirty.append((offset, RECORD.size + length))
+
+    def get(self, level):
+        # The map and the objects (savegame bytes) stored for the level, None if it isn't stored
+        if level not in self.records:
+            return None
+        offset = self.records[level][0]
+        length = RECORD.unpack_from(self.map, offset)[2]
+        end = offset + RECORD.size + length
+        position = offset + RECORD.size
+        width, height, chunk_size, blocked, count = LEVEL.unpack_from(self.map, position)
+        position += LEVEL.size
+        world_map = WorldMap(width, height, blocked != 0, chunk_size)
+        size = chunk_size * chunk_size
+        for i in range(count):
+            chunk = world_map.chunk(*CHUNK.unpack_from(self.map, position))
+            position += CHUNK.size
+            for plane in PLANES:
+                setattr(chunk, plane, bytearray(self.map[position:position + size]))
+                position += size
+        return world_map, self.map[position:end]
+
+    def flush(self):
+        # Write the changed records out to the file, the rest of it is left alone
+        for (offset, length) in self.dirty:
+            # flush() wants the start of a page
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, offset + length - start)
+        self.dirty = []
+
+    def copy(self, filename):
+        # The store written out whole to another file, for a game saved under a new name
+        self.flush()
+        with open(filename, 'wb') as f:
+            f.write(self.map[:self.end])
+        return LevelStore(filename, self.seed)
+
+    def close(self):
+        if self.map is not None:
+            self.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
@@ -914,9 +914,9 @@ def console_fill_foreground(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -935,9 +935,9 @@ def console_fill_background(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -952,7 +952,7 @@ def console_fill_background(con,r,g,b) :
 def console_fill_char(con,arr) :
     if (numpy_available and isinstance(arr, numpy.ndarray) ):
         #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
         carr = arr.ctypes.data_as(POINTER(c_int))
     else:
         #otherwise convert using the struct module
@@ -1519,6 +1519,30 @@ def map_copy(source, dest):
 def map_set_properties(m, x, y, isTrans, isWalk):
     _lib.TCOD_map_set_properties(m, x, y, c_int(isTrans), c_int(isWalk))
 
+# libtcod's map_t. Every cell is one byte: bit 0 transparent, bit 1 walkable, bit 2 in fov
+class _CMap(Structure):
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('nbcells', c_int),
+              ('cells', POINTER(c_ubyte)),
+              ]
+
+MAP_TRANSPARENT = 1
+MAP_WALKABLE = 2
+MAP_IN_FOV = 4
+
+def map_set_cells(m, cells):
+    # set every cell in one call from width*height bytes, row by row, made of the bits above
+    cmap = cast(m, POINTER(_CMap)).contents
+    if len(cells) != cmap.nbcells:
+        raise ValueError('map has %d cells, got %d' % (cmap.nbcells, len(cells)))
+    memmove(cmap.cells, bytes(cells), cmap.nbcells)
+
+def map_get_cells(m):
+    # all cells in one call, as a bytearray of the bits above
+    cmap = cast(m, POINTER(_CMap)).contents
+    return bytearray(string_at(cmap.cells, cmap.nbcells))
+
 def map_clear(m,walkable=False,transparent=False):
     _lib.TCOD_map_clear(m,c_int(walkable),c_int(transparent))
 
@@ -1,18 +1,45 @@
 import libtcodpy as libtcod
+import collections
+import copy
+import io
 import math
+import os
 import textwrap
-import shelve
+import zlib
+import registry
+import savefile
+from autosave import Autosaver
+from fovcache import FovCache
+from levelgen import LevelPipeline
+from levelstore import LevelStore
+from profiler import Profiler
+from recording import Recorder
 from constants import *
+from worldmap import PLANES, RoomMask, WorldMap
+from objectlist import ObjectList
+from scheduler import Scheduler
+from spawntable import AliasTable
+
+try:  # NumPy is optional, it is only used by the bulk map renderer
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
 
 # ----------------------CLASS DEFINITIONS-----------------------
 
-class Object:
+class Object(savefile.Record):
     """This is a generic object: the player, a monster, an item, the stairs.."""
+    __slots__ = ('_x', '_y', 'char', 'name', 'color', 'blocks', 'always_visible', 'is_player', 'level', 'speed',
+                 'fighter', 'ai', 'item', 'equipment', 'container', 'controller')
+    defaults = {'speed': NORMAL_SPEED}
 
     def __init__(self, x, y, char, name, color, blocks=False,
                  always_visible=False, fighter=None,
-                 ai=None, item=None, equipment=None, is_player=False, controller=None, container=None):
+                 ai=None, item=None, equipment=None, is_player=False, controller=None, container=None,
+                 speed=NORMAL_SPEED):
         self.is_player = is_player
+        self.speed = speed
         self.always_visible = always_visible
         self.item = item
         if self.item:  # let the item component know it's owner
@@ -37,21 +64,46 @@ class Object:
             self.controller.owner = self
         self.name = name
         self.blocks = blocks
-        self.x = x
-        self.y = y
+        self._x = x
+        self._y = y
         self.char = char
         self.color = color
 
+    # Position changes are reported to the object list so it's tile hash stays up to date
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        old_x = self._x
+        self._x = value
+        if old_x != value:
+            objects.moved(self, old_x, self._y)
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        old_y = self._y
+        self._y = value
+        if old_y != value:
+            objects.moved(self, self._x, old_y)
+
     def draw(self):
-        # set the color and then draw the char that represents this object at its position
-        if (libtcod.map_is_in_fov(fov_map, self.x, self.y)) or (
-                    self.always_visible and world_map[self.x][self.y].explored):
+        # set the color and then draw the char that represents this object at its position on screen
+        if not in_view(self.x, self.y):
+            return
+        if in_fov(self.x, self.y) or (self.always_visible and world_map[self.x][self.y].explored):
             libtcod.console_set_default_foreground(con, self.color)
-            libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
+            libtcod.console_put_char(con, self.x - camera_x, self.y - camera_y, self.char, libtcod.BKGND_NONE)
 
     def clear(self):
         # erase character that represents the object
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
+        if in_view(self.x, self.y):
+            libtcod.console_put_char(con, self.x - camera_x, self.y - camera_y, ' ', libtcod.BKGND_NONE)
 
 
     def distance_to(self, other):
@@ -71,8 +123,10 @@ class Object:
         objects.insert(0, self)
 
 
-class Container:
+class Container(savefile.Record):
     # an object that holds other objects inside it
+    __slots__ = ('owner', 'size', 'inventory')
+
     def __init__(self, size):
         self.size = size
         self.inventory = []
@@ -100,20 +154,9 @@ class Container:
         return None
 
 
-class Tile:
-    """A tile of the map and it's properties"""
-
-    def __init__(self, blocked, block_sight=None):
-        self.blocked = blocked
-        self.explored = False
-
-        # by default, if a tile is blocked it also blocks sight
-        if block_sight is None: block_sight = blocked
-        self.block_sight = block_sight
-
-
-class Rect:
+class Rect(object):
     """A rectangle on the map, used to characterize a room"""
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
 
     def __init__(self, x, y, w, h):
         self.x1 = x
@@ -122,8 +165,8 @@ class Rect:
         self.y2 = y + h
 
     def center(self):
-        center_x = (self.x1 + self.x2) / 2
-        center_y = (self.y1 + self.y2) / 2
+        center_x = (self.x1 + self.x2) // 2
+        center_y = (self.y1 + self.y2) // 2
         return center_x, center_y
 
     def intersect(self, other):
@@ -131,9 +174,19 @@ class Rect:
         return ( self.x1 <= other.x2 and self.x2 >= other.x1 and
                  self.y1 <= other.y2 and self.y2 >= other.y1 )
 
+    def contains(self, x, y):
+        return self.x1 <= x <= self.x2 and self.y1 <= y <= self.y2
 
-class Controller:
+    def distance(self, x, y):
+        # Distance from a point to the closest point of the rectangle, 0 inside it
+        dx = max(self.x1 - x, 0, x - self.x2)
+        dy = max(self.y1 - y, 0, y - self.y2)
+        return math.sqrt(dx ** 2 + dy ** 2)
+
+
+class Controller(savefile.Record):
     """Component class. Ai and players both control objects through same interface"""
+    __slots__ = ('owner',)
 
     def __init__(self):
         pass
@@ -156,18 +209,43 @@ class Controller:
         self.move(dx, dy)
 
     def path_to(self, dx, dy):
-        # use algorithm to move (A*)
-        path = libtcod.path_new_using_map(fov_map, 1.41)
-        libtcod.path_compute(path, self.owner.x, self.owner.y, dx, dy)
-        if not libtcod.path_is_empty(path):
-            x, y = libtcod.path_walk(path, True)
-            if not x is None:
-                self.move_towards(x, y)
-        libtcod.path_delete(path)
-
-
-class Fighter:
+        # use algorithm to move (A*). Paths only exist inside the active area, from outside it just head there
+        if not (in_active_area(self.owner.x, self.owner.y) and in_active_area(dx, dy)):
+            self.move_towards(dx, dy)
+            return
+        step = path_step(self.owner.x, self.owner.y, dx, dy)
+        if step is not None:
+            self.move_towards(*step)
+
+    def chase(self, target):
+        # Step to the neighbouring tile that is closest to the target. Everyone hunting the player shares
+        # the chase map, other targets fall back to A*
+        if target is not player or not in_active_area(self.owner.x, self.owner.y):
+            self.path_to(target.x, target.y)
+            return
+        update_chase_map()
+        best_step = None
+        best_distance = libtcod.dijkstra_get_distance(chase_map, self.owner.x - active_x, self.owner.y - active_y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                x = self.owner.x + dx
+                y = self.owner.y + dy
+                if not in_active_area(x, y) or is_blocked(x, y):
+                    continue
+                distance = libtcod.dijkstra_get_distance(chase_map, x - active_x, y - active_y)
+                # negative distance means the tile can't be reached from the target
+                if 0 <= distance < best_distance:
+                    best_step = (dx, dy)
+                    best_distance = distance
+        if best_step is not None:
+            self.move(*best_step)
+
+
+class Fighter(savefile.Record):
     """Component class. Any object that is a fighter can deal and receive damage"""
+    __slots__ = ('owner', 'attack_effect_function', 'death_function', 'base_max_hp', 'hp', 'base_defense',
+                 'base_power', 'xp', 'active_effects', 'killed_by', 'stats')
+    defaults = {'killed_by': None, 'stats': None}
 
     def __init__(self, hp, defense, power, xp, death_function=None, attack_effect_function=None):
         self.attack_effect_function = attack_effect_function
@@ -178,38 +256,52 @@ class Fighter:
         self.base_power = power
         self.xp = xp
         self.active_effects = []
+        self.killed_by = None
+        self.stats = None
 
+    # Power, defense and max hp including equipment and effects. They are cached, anything that changes
+    # equipment, effects or base stats must call invalidate_stats()
     @property
     def power(self):
-        bonus = 0
-        if self.owner.container:
-            bonus += sum(equipment.power_bonus for equipment in self.owner.container.get_all_equipped())
-        bonus += sum(effect.power_mod for effect in self.active_effects)
-        return self.base_power + bonus
+        return (self.stats or self.update_stats())[0]
 
     @property
     def defense(self):
-        bonus = 0
-        if self.owner.container:
-            bonus += sum(equipment.defense_bonus for equipment in self.owner.container.get_all_equipped())
-        bonus += sum(effect.defense_mod for effect in self.active_effects)
-
-        return self.base_defense + bonus
+        return (self.stats or self.update_stats())[1]
 
     @property
     def max_hp(self):
-        bonus = 0
-        if self.owner.container:
-            bonus += sum(equipment.max_hp_bonus for equipment in self.owner.container.get_all_equipped())
-        bonus += sum(effect.max_hp_mod for effect in self.active_effects)
-        return self.base_max_hp + bonus
-
-    def take_damage(self, damage):
-        # apply damage if possible
+        return (self.stats or self.update_stats())[2]
+
+    def update_stats(self):
+        equipped = self.owner.container.get_all_equipped() if self.owner.container else []
+        power = self.base_power + sum(equipment.power_bonus for equipment in equipped)
+        defense = self.base_defense + sum(equipment.defense_bonus for equipment in equipped)
+        max_hp = self.base_max_hp + sum(equipment.max_hp_bonus for equipment in equipped)
+        for effect in self.active_effects:
+            power += effect.power_mod
+            defense += effect.defense_mod
+            max_hp += effect.max_hp_mod
+        self.stats = (power, defense, max_hp)
+        return self.stats
+
+    def invalidate_stats(self):
+        self.stats = None
+
+    def add_effect(self, effect):
+        self.active_effects.append(effect)
+        self.invalidate_stats()
+        # effects wear off on the owner's turns, so it needs to be woken up even without an ai
+        if self.owner not in scheduler:
+            scheduler.add(self.owner, action_delay(self.owner))
+
+    def take_damage(self, damage, source=None):
+        # apply damage if possible, source is the name of whatever dealt it
         if damage > 0:
             self.hp -= damage
             if self.hp <= 0:
                 self.hp = 0
+                self.killed_by = source
                 function = self.death_function
                 if function is not None:
                     function(self.owner)
@@ -225,12 +317,12 @@ class Fighter:
             # make the target take some damage
             message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.',
                     libtcod.yellow)
-            target.fighter.take_damage(damage)
+            target.fighter.take_damage(damage, self.owner.name)
         else:
             # take minimal damage
             message(self.owner.name.capitalize() + ' attacks ' + target.name + ', but it is not very effective!',
                     libtcod.yellow)
-            target.fighter.take_damage(1)
+            target.fighter.take_damage(1, self.owner.name)
         if self.attack_effect_function:
             self.attack_effect_function(self, target)
 
@@ -247,10 +339,13 @@ class Fighter:
             if effect.duration <= 0:
                 message(self.owner.name.capitalize() + ' is no longer under ' + effect.name, libtcod.orange)
                 self.active_effects.remove(effect)
+                self.invalidate_stats()
 
 
 # --- AI Classes
-class PlayerAi:
+class PlayerAi(savefile.Record):
+    __slots__ = ('owner',)
+
     def __init__(self):
         pass
 
@@ -258,8 +353,9 @@ class PlayerAi:
         handle_keys()
 
 
-class BasicMonster:
+class BasicMonster(savefile.Record):
     """Basic monster AI"""
+    __slots__ = ('owner', 'target')
 
     def __init__(self, target=None):
         self.target = target
@@ -267,22 +363,24 @@ class BasicMonster:
     def take_turn(self):
         # A basic monster takes it's turn, if you can see it, it can see you
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if in_fov(monster.x, monster.y):
             # add player as target if in fov
             self.target = player
         if self.target:
             # move towards target if far away
             if monster.distance_to(self.target) >= 2:
-                monster.controller.path_to(self.target.x, self.target.y)
+                monster.controller.chase(self.target)
             # Close enough to attack (if target alive)
             elif self.target.fighter.hp > 0:
                 monster.fighter.attack(self.target)
         else:  # otherwise move randomly
-            monster.controller.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            monster.controller.move(libtcod.random_get_int(rng['ai'], -1, 1), libtcod.random_get_int(rng['ai'], -1, 1))
 
 
-class ConfusedMonster:
+class ConfusedMonster(savefile.Record):
     # AI for a confused monster (reverts to previous ai after a while)
+    __slots__ = ('owner', 'old_ai', 'num_turns')
+
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         self.old_ai = old_ai
         self.num_turns = num_turns
@@ -290,7 +388,7 @@ class ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0:  # Still confused
             # move in random direction and reduce number of turns left confused
-            self.owner.controller.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.controller.move(libtcod.random_get_int(rng['ai'], -1, 1), libtcod.random_get_int(rng['ai'], -1, 1))
             self.num_turns -= 1
         else:  # restore old ai (and this one gets destroyed due to no references)
             self.owner.ai = self.old_ai
@@ -299,8 +397,10 @@ class ConfusedMonster:
 
 # / ---- AI Classes
 
-class Item:
+class Item(savefile.Record):
     # An item that can be picked up and used
+    __slots__ = ('owner', 'use_function', 'param')
+
     def __init__(self, use_function=None, param=None):
         self.use_function = use_function
         self.param = param
@@ -347,8 +447,10 @@ class Item:
                     wearer.container.remove(self.owner)  # Destroy after use, unless it was cancelled for some reason
 
 
-class Equipment:
+class Equipment(savefile.Record):
     # An equippable object, yielding bonuses to it's wielder. Automatically adds Item component
+    __slots__ = ('owner', 'slot', 'is_equipped', 'power_bonus', 'defense_bonus', 'max_hp_bonus')
+
     def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
         self.slot = slot
         self.is_equipped = False
@@ -371,17 +473,23 @@ class Equipment:
 
         # equip object and show message about it
         self.is_equipped = True
+        if wearer.fighter:
+            wearer.fighter.invalidate_stats()
         message(wearer.name.capitalize() + ' equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.green)
 
     def unequip(self, wearer):
         # unequip object and show message about it
         self.is_equipped = False
+        if wearer.fighter:
+            wearer.fighter.invalidate_stats()
         message(wearer.name.capitalize() + ' unequipped ' + self.owner.name + ' from ' + self.slot + '.',
                 libtcod.light_yellow)
 
 
-class Effect:
+class Effect(savefile.Record):
     # A temporary effect (by an attack etc)
+    __slots__ = ('name', 'duration', 'power_mod', 'defense_mod', 'max_hp_mod')
+
     def __init__(self, name, duration=None, power_mod=0, defense_mod=0, max_hp_mod=0):
         self.name = name
         self.duration = duration
@@ -394,238 +502,260 @@ class Effect:
 
 def is_blocked(x, y):
     # First test the map
-    if map[x][y].blocked:
+    if world_map.is_blocked(x, y):
         return True
     # Then check objects
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
-
-    return False
+    return objects.is_blocked(x, y)
+
+
+def update_chase_map():
+    # Distances from the player to every walkable tile of the active area, computed once per player position and
+    # shared by all monsters. The walkable layout only changes with a new fov_map, activate_area() throws the
+    # chase map away then
+    global chase_map, chase_origin
+    if chase_map is None:
+        chase_map = libtcod.dijkstra_new(fov_map, 1.41)
+        chase_origin = None
+    if chase_origin != (player.x, player.y):
+        libtcod.dijkstra_compute(chase_map, player.x - active_x, player.y - active_y)
+        chase_origin = (player.x, player.y)
+
+
+def path_step(x, y, target_x, target_y):
+    # The first step of an A* path between two tiles of the active area, None if there is no path
+    path = libtcod.path_new_using_map(fov_map, 1.41)
+    libtcod.path_compute(path, x - active_x, y - active_y, target_x - active_x, target_y - active_y)
+    step = None
+    if not libtcod.path_is_empty(path):
+        step_x, step_y = libtcod.path_walk(path, True)
+        if step_x is not None:
+            step = (step_x + active_x, step_y + active_y)
+    libtcod.path_delete(path)
+    return step
 
 
 def create_room(room):
     global world_map
-    # go through the tiles in the rectangle and set them to unblocked
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            world_map[x][y].blocked = False
-            world_map[x][y].block_sight = False
-
-
-def place_objects(room):
-    # maximum number of monsters per room
-    max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
-
-    # chance of each monster
-    monster_chances = {'zombie': 60, 'orc': from_dungeon_level([[50, 1], [60, 2], [70, 3]]),
-                       'troll': from_dungeon_level([[15, 3], [30, 5], [60, 7]]),
-                       'ogre': from_dungeon_level([[15, 7], [30, 10], [40, 13]]),
-                       'dragon': from_dungeon_level([[10, 10], [20, 13], [25, 15]]),
-                       'cthulhu': from_dungeon_level([[10, 13], [15, 15]])}
-
-    # maximum number of items per room
-    max_items = from_dungeon_level([[1, 1], [2, 5], [3, 9]])
-
-    # chance of each item
-    item_chances = {'sword': from_dungeon_level([[5, 4]]), 'shield': from_dungeon_level([[15, 8]]),
-                    'small_heal': from_dungeon_level([[35, 1], [10, 6]]), 'lightning': from_dungeon_level([[25, 4]]),
-                    'fireball': from_dungeon_level([[25, 6]]), 'confuse': from_dungeon_level([[10, 2], [15, 6]]),
-                    'big_heal': from_dungeon_level([[35, 6]])}
-
-    num_monsters = libtcod.random_get_int(0, 1, max_monsters)
+    # set the tiles inside the rectangle to unblocked
+    world_map.carve(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
+
+
+def load_prototypes():
+    # Compile the monster and item definitions into prototype objects, once. Every monster and item in the
+    # game is a clone of one of these
+    global monster_types, item_types
+    if monster_types is not None:
+        return
+    definitions = registry.load(MONSTER_CONFIG, MONSTER_CACHE)
+    item_types = collections.OrderedDict()
+    for (name, (char, color, use, param, slot, power_bonus, defense_bonus, max_hp_bonus,
+                chances)) in definitions['item']:
+        if slot:
+            equipment = Equipment(slot, power_bonus=power_bonus or 0, defense_bonus=defense_bonus or 0,
+                                  max_hp_bonus=max_hp_bonus or 0)
+            prototype = Object(0, 0, char, name, color, equipment=equipment)
+        else:
+            prototype = Object(0, 0, char, name, color, item=Item(use_function=config_function(use), param=param))
+        item_types[name] = (prototype, chance_table(chances))
+    monster_types = collections.OrderedDict()
+    for (name, (char, color, hp, defense, power, xp, death, attack_effect, chances,
+                carries)) in definitions['monster']:
+        if carries and carries not in item_types:
+            raise registry.RegistryError('The %s carries an unknown item: %s' % (name, carries))
+        fighter = Fighter(hp=hp or 0, defense=defense or 0, power=power or 0, xp=xp or 0,
+                          death_function=config_function(death), attack_effect_function=config_function(attack_effect))
+        prototype = Object(0, 0, char, name, color, blocks=True, fighter=fighter, ai=BasicMonster(),
+                           controller=Controller(), container=Container(2) if carries else None)
+        monster_types[name] = (prototype, chance_table(chances), carries)
+
+
+def config_function(name):
+    # The function a definition names, it has to be one that savegames can store
+    if name is None:
+        return None
+    function = savefile.lookup_function(name)
+    if function is None:
+        raise registry.RegistryError('Unknown function in %s: %s' % (MONSTER_CONFIG, name))
+    return function
+
+
+def chance_table(chances):
+    # [chance, level, chance, level...] from the config as a from_dungeon_level() table
+    chances = chances or []
+    return [[chances[i], chances[i + 1]] for i in range(0, len(chances) - 1, 2)]
+
+
+def spawn_table():
+    # What rooms of the current dungeon level get: (maximum monsters per room, table of monster names,
+    # maximum items per room, table of item names). It only changes with the level, so it's made once per level.
+    # The tables list names in the order of the config, so the same seed always spawns the same things
+    if dungeon_lvl not in spawn_tables:
+        load_prototypes()
+        monsters = AliasTable(list(monster_types), [from_dungeon_level(table)
+                                                    for (prototype, table, carries) in monster_types.values()])
+        items = AliasTable(list(item_types), [from_dungeon_level(table) for (prototype, table) in item_types.values()])
+        spawn_tables[dungeon_lvl] = (from_dungeon_level([[2, 1], [3, 4], [5, 6]]), monsters,
+                                     from_dungeon_level([[1, 1], [2, 5], [3, 9]]), items)
+    return spawn_tables[dungeon_lvl]
+
+
+def spawn(prototype, x, y):
+    # A new object at (x, y) cloned from a prototype, with copies of it's components
+    obj = copy.copy(prototype)
+    obj._x = x
+    obj._y = y
+    for name in ('fighter', 'ai', 'item', 'equipment', 'container', 'controller'):
+        component = getattr(prototype, name)
+        if component:
+            component = copy.copy(component)
+            component.owner = obj
+            setattr(obj, name, component)
+    if obj.fighter:
+        obj.fighter.active_effects = []
+        obj.fighter.invalidate_stats()
+    if obj.container:
+        obj.container.inventory = []
+    return obj
+
+
+def place_objects(room, floor_items):
+    # Put monsters and items in a room. Monsters go on the map right away, so the next ones don't land on them.
+    # Items are only added to floor_items, the map generator puts all of them in front of objects at once.
+    # Nothing here shows messages, the level isn't being played yet
+    # maximum number of monsters and items per room, and the chance of each monster and item
+    max_monsters, monster_table, max_items, item_table = spawn_table()
+    if not monster_table:
+        max_monsters = 0  # nothing can spawn this deep
+    if not item_table:
+        max_items = 0
+
+    num_monsters = libtcod.random_get_int(rng['spawn'], 1, max_monsters) if max_monsters else 0
 
     for i in range(num_monsters):
         # Choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = libtcod.random_get_int(rng['spawn'], room.x1 + 1, room.x2 - 1)
+        y = libtcod.random_get_int(rng['spawn'], room.y1 + 1, room.y2 - 1)
 
         while is_blocked(x, y):
-            x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-            y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
-
-        choice = random_choice(monster_chances)
-        controller = Controller()
-        if choice == 'zombie':
-            fighter_component = Fighter(hp=10, defense=0, power=2, xp=15, death_function=monster_death,
-                                        attack_effect_function=zombie_bite)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'z', 'zombie', libtcod.chartreuse, blocks=True, fighter=fighter_component,
-                             ai=ai_component, controller=controller)
-        elif choice == 'orc':
-            orc_bag = Container(2)
-            equipment_component = Equipment(slot='main-hand', power_bonus=2)
-            item = Object(x, y, '/', 'orcish sword', libtcod.sky, equipment=equipment_component)
-            objects.append(item)
-            fighter_component = Fighter(hp=20, defense=1, power=4, xp=25, death_function=monster_death,
-                                        attack_effect_function=orc_berserk)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'o', 'orc', libtcod.desaturated_green, blocks=True, fighter=fighter_component,
-                             ai=ai_component, controller=controller, container=orc_bag)
-            item.item.pick_up(monster)
-        elif choice == 'troll':
-            fighter_component = Fighter(hp=30, defense=2, power=8, xp=75, death_function=monster_death)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'T', 'troll', libtcod.desaturated_green, blocks=True, fighter=fighter_component,
-                             ai=ai_component, controller=controller)
-        elif choice == 'ogre':
-            fighter_component = Fighter(hp=40, defense=2, power=10, xp=100, death_function=monster_death)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'O', 'ogre', libtcod.desaturated_red, blocks=True, fighter=fighter_component,
-                             ai=ai_component, controller=controller)
-        elif choice == 'dragon':
-            fighter_component = Fighter(hp=60, defense=3, power=15, xp=150, death_function=monster_death)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'D', 'dragon', libtcod.red, blocks=True, fighter=fighter_component, ai=ai_component,
-                             controller=controller)
-        elif choice == 'cthulhu':
-            fighter_component = Fighter(hp=100, defense=4, power=20, xp=200, death_function=cthulhu_death)
-            ai_component = BasicMonster()
-            monster = Object(x, y, 'C', 'cthulhu', libtcod.brass, blocks=True, fighter=fighter_component,
-                             ai=ai_component, controller=controller)
+            x = libtcod.random_get_int(rng['spawn'], room.x1 + 1, room.x2 - 1)
+            y = libtcod.random_get_int(rng['spawn'], room.y1 + 1, room.y2 - 1)
+
+        prototype, table, carries = monster_types[monster_table.draw(rng['spawn'])]
+        monster = spawn(prototype, x, y)
+        if carries:
+            give(spawn(item_types[carries][0], x, y), monster, floor_items)
         objects.append(monster)
 
     # Choose random number of items
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = libtcod.random_get_int(rng['loot'], 0, max_items)
 
     for i in range(num_items):
         # Choose random spot for this item
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = libtcod.random_get_int(rng['loot'], room.x1 + 1, room.x2 - 1)
+        y = libtcod.random_get_int(rng['loot'], room.y1 + 1, room.y2 - 1)
         # Only place if the spot ain't blocked
 
         while is_blocked(x, y):
-            x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-            y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
-
-        choice = random_choice(item_chances)
-
-        if choice == 'small_heal':
-            item_component = Item(use_function=cast_heal, param=HEAL_AMOUNT)
-            item = Object(x, y, '!', 'healing potion', libtcod.violet, item=item_component)
-        elif choice == 'lightning':
-            item_component = Item(use_function=cast_lightning)
-            item = Object(x, y, '#', 'scroll of lightning bolt', libtcod.light_blue, item=item_component)
-        elif choice == 'fireball':
-            item_component = Item(use_function=cast_fireball)
-            item = Object(x, y, '#', 'scroll of fireball', libtcod.red, item=item_component)
-        elif choice == 'confuse':
-            item_component = Item(use_function=cast_confuse)
-            item = Object(x, y, '#', 'scroll of confusion', libtcod.light_blue, item=item_component)
-        elif choice == 'big_heal':
-            item_component = Item(use_function=cast_heal, param=BIG_HEAL_AMOUNT)
-            item = Object(x, y, '!', 'greater healing potion', libtcod.dark_violet, item=item_component)
-        elif choice == 'sword':
-            equipment_component = Equipment(slot='main-hand', power_bonus=3)
-            item = Object(x, y, '/', 'sword', libtcod.sky, equipment=equipment_component)
-        elif choice == 'shield':
-            equipment_component = Equipment(slot='off-hand', defense_bonus=3)
-            item = Object(x, y, '[', 'shield', libtcod.sky, equipment=equipment_component)
-
-        objects.append(item)
-        item.send_to_back()
-
-
-def create_h_tunnel(x1, x2, y):
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
-
-
-def create_v_tunnel(y1, y2, x):
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+            x = libtcod.random_get_int(rng['loot'], room.x1 + 1, room.x2 - 1)
+            y = libtcod.random_get_int(rng['loot'], room.y1 + 1, room.y2 - 1)
+
+        floor_items.append(spawn(item_types[item_table.draw(rng['loot'])][0], x, y))
+
+
+def give(item, wearer, floor_items):
+    # Hand a new item to a monster like pick_up() would, without the messages. Equipment is worn if the slot is
+    # free, an item that doesn't fit stays on the floor
+    if not wearer.container.add(item):
+        floor_items.append(item)
+        return
+    equipment = item.equipment
+    if equipment and wearer.container.get_equipped_in(equipment.slot) is None:
+        equipment.is_equipped = True
+        if wearer.fighter:
+            wearer.fighter.invalidate_stats()
 
 
 def bsp_make_map():
-    global world_map, objects, stairs, rooms
-    objects = [player]
-    world_map = [[Tile(True)
-                  for y in range(MAP_HEIGHT)]
-                 for x in range(MAP_WIDTH)]
+    global world_map, objects, stairs, rooms, room_mask
+    objects = ObjectList([player])
+    world_map = WorldMap(MAP_WIDTH, MAP_HEIGHT)
+    room_mask = RoomMask(MAP_WIDTH, MAP_HEIGHT)
     my_bsp = libtcod.bsp_new_with_size(0, 0, MAP_WIDTH, MAP_HEIGHT)
-    libtcod.bsp_split_recursive(my_bsp, 0, 6, ROOM_MIN_SIZE, ROOM_MIN_SIZE, 1.2, 1.1)
+    libtcod.bsp_split_recursive(my_bsp, rng['mapgen'], 6, ROOM_MIN_SIZE, ROOM_MIN_SIZE, 1.2, 1.1)
     rooms = []
     libtcod.bsp_traverse_inverted_level_order(my_bsp, make_room)
+    libtcod.bsp_delete(my_bsp)
+    room_mask = None
     num_rooms = 0
 
     for room in rooms:
-        (r_x, r_y) = room.center
+        (r_x, r_y) = room.center()
         if num_rooms == 0:
             player.x = r_x
             player.y = r_y
         else:
-            (prev_x, prev_y) = rooms[num_rooms - 1].center
-            # Draw a coin (random 0 or 1)
-            if libtcod.random_get_int(0, 0, 1) == 1:
-                # first move horizontally, then vertically
-                create_h_tunnel(prev_x, r_x, prev_y)
-                create_v_tunnel(prev_y, r_y, r_x)
-            else:
-                # first move vertically, then horizontally
-                create_v_tunnel(prev_y, r_y, prev_x)
-                create_h_tunnel(prev_x, r_x, r_y)
+            (prev_x, prev_y) = rooms[num_rooms - 1].center()
+            # Draw a coin (random 0 or 1): 1 moves horizontally first, then vertically
+            world_map.carve_corridor(prev_x, prev_y, r_x, r_y, libtcod.random_get_int(rng['mapgen'], 0, 1) == 1)
 
         num_rooms += 1
     # Add stairs to last room
     stairs = Object(r_x, r_y, '<', 'stairs', libtcod.white, always_visible=True)
     objects.append(stairs)
     stairs.send_to_back()
+    place_upstairs()
 
 
-def make_room(node=None):
-    w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-    h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+def make_room(node, user_data=None):
+    # bsp traversal callback, returning True carries on with the next node
+    w = min(libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE), node.w - 1)
+    h = min(libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE), node.h - 1)
     x = node.x  # libtcod.random_get_int(0, node.w - w - 1)
     y = node.y  # libtcod.random_get_int(0, node.h - h - 1)
     new_room = Rect(x, y, w, h)
-    for other_room in rooms:
-        if new_room.intersect(other_room):
-            return
+    if room_mask.overlaps(new_room.x1, new_room.y1, new_room.x2, new_room.y2):
+        return True
+    room_mask.add(new_room.x1, new_room.y1, new_room.x2, new_room.y2)
     create_room(new_room)
     rooms.append(new_room)
+    return True
 
 
-def make_map():
-    global world_map, objects, stairs
-    objects = [player]
+def make_map(width=MAP_WIDTH, height=MAP_HEIGHT, max_rooms=MAX_ROOMS):
+    global world_map, objects, stairs, rooms
+    objects = ObjectList([player])
 
     # first block all tiles
-    # (list comprehension!)
-    world_map = [[Tile(True)
-                  for y in range(MAP_HEIGHT)]
-                 for x in range(MAP_WIDTH)]
+    world_map = WorldMap(width, height)
+    # and remember where the rooms are, to test new ones for overlap with all of them at once
+    mask = RoomMask(width, height)
 
     world_rooms = []
+    floor_items = []
     num_rooms = 0
 
-    for r in range(MAX_ROOMS):
+    for r in range(max_rooms):
         # Random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         # Random position on map without going out of bounds
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng['mapgen'], 0, width - w - 1)
+        y = libtcod.random_get_int(rng['mapgen'], 0, height - h - 1)
         # 'Rect' class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
 
-        # Run through other rooms and see if they intersect
-        failed = False
-        for other_room in world_rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-        if not failed:
+        # See if it intersects other rooms
+        if not mask.overlaps(new_room.x1, new_room.y1, new_room.x2, new_room.y2):
             # This means no intersections, room is valid
             # 'Carve' out of map
+            mask.add(new_room.x1, new_room.y1, new_room.x2, new_room.y2)
             create_room(new_room)
 
             # Add content to this room, like monsters, but not in the first room
             if world_rooms:
-                place_objects(new_room)
+                place_objects(new_room, floor_items)
             # Get center coordinates
-            (new_x, new_y) = new_room.center
+            (new_x, new_y) = new_room.center()
             # optional: print "room number" to see how the map drawing workedcancelled
             # we may have more than ten rooms, so print 'A' for the first room, 'B' for the next...
             # room_no = Object(new_x, new_y, chr(65+num_rooms), libtcod.white)
@@ -638,25 +768,34 @@ def make_map():
             else:
                 # All rooms after first
                 # Connect it to previous room with a tunnel
-                (prev_x, prev_y) = world_rooms[num_rooms - 1].center
-
-                # Draw a coin (random 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
-                    # first move horizontally, then vertically
-                    create_h_tunnel(prev_x, new_x, prev_y)
-                    create_v_tunnel(prev_y, new_y, new_x)
-                else:
-                    # first move vertically, then horizontally
-                    create_v_tunnel(prev_y, new_y, prev_x)
-                    create_h_tunnel(prev_x, new_x, new_y)
+                (prev_x, prev_y) = world_rooms[num_rooms - 1].center()
+
+                # Draw a coin (random 0 or 1): 1 moves horizontally first, then vertically
+                world_map.carve_corridor(prev_x, prev_y, new_x, new_y,
+                                         libtcod.random_get_int(rng['mapgen'], 0, 1) == 1)
 
             # finally append room to rooms
             world_rooms.append(new_room)
             num_rooms += 1
+    rooms = world_rooms
+    # items are drawn first, under the monsters
+    objects.extend_front(floor_items)
+
     # Add stairs to last room
     stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white, always_visible=True)
     objects.append(stairs)
     stairs.send_to_back()
+    place_upstairs()
+
+
+def place_upstairs():
+    # Stairs back up where the player starts, on every level but the first
+    global upstairs
+    upstairs = None
+    if dungeon_lvl > 1:
+        upstairs = Object(player.x, player.y, '>', 'stairs up', libtcod.white, always_visible=True)
+        objects.append(upstairs)
+        upstairs.send_to_back()
 
 
 # Key press handling
@@ -670,7 +809,8 @@ def handle_keys():
     # key = libtcod.console_wait_for_keypress(True)  #turn-based
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         # Alt+Enter: toggle fullscreen
-        libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
+        if not headless:
+            libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
     elif key.vk == libtcod.KEY_ESCAPE:
         return 'exit'
 
@@ -698,8 +838,8 @@ def handle_keys():
 
             if key_char == 'g':
                 # pick up an item
-                for object in objects:  # look for an item in the players tile
-                    if object.item and object.x == player.x and object.y == player.y:
+                for object in objects.at(player.x, player.y):  # look for an item in the players tile
+                    if object.item:
                         object.item.pick_up(player)
                 return  # end turn even if noting got picked
             if key_char == 'i':
@@ -717,6 +857,10 @@ def handle_keys():
                 # Go down stairs if player is on them
                 if stairs.x == player.x and stairs.y == player.y:
                     next_level()
+            if key_char == '>':
+                # Go back up if player is on the stairs up
+                if upstairs and upstairs.x == player.x and upstairs.y == player.y:
+                    previous_level()
             if key_char == 'f':
                 # Show character information
                 level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
@@ -726,36 +870,15 @@ def handle_keys():
                        '\nMax HP : ' + str(player.fighter.max_hp) +
                        '\nAttack : ' + str(player.fighter.power) +
                        '\nDefense : ' + str(player.fighter.defense), CHARACTER_SCREEN_WIDTH)
-            if key_char == 'r':
+            if key_char == 'r' and not headless:
                 # take screenshot!
                 libtcod.sys_save_screenshot()
+            if key_char == 'p' and not headless:
+                # show where the time goes
+                toggle_profile()
             return 'didnt-take-turn'
 
 
-def random_choice_index(chances):  # choose one option from a list of chances, returning it's index
-    # the dice will land on some number between 1 and the sum of chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
-
-    # go through all chances, keeping the sum so far
-    running_sum = 0
-    choice = 0
-
-    for w in chances:
-        running_sum += w
-
-        # see if dice landed in the part that corresponds to this choice
-        if dice <= running_sum:
-            return choice
-        choice += 1
-
-
-def random_choice(chances_dict):
-    # return one option from dictionary with chances, returning it's key
-    chances = chances_dict.values()
-    strings = chances_dict.keys()
-    return strings[random_choice_index(chances)]
-
-
 def from_dungeon_level(table):
     # Returns a value that depends on level. The table specifies what value occurs after each level, default is 0
     for (value, level) in reversed(table):
@@ -764,57 +887,239 @@ def from_dungeon_level(table):
     return 0
 
 
+def lit_tiles(cells):
+    # The tiles lit in the fov map cells, which cover the active area: (x, y) is cell (x - active_x, y - active_y).
+    # Nothing outside the torch radius can be in FOV, so only that box around the player is scanned
+    lit = set()
+    bottom = min(active_y + active_height, player.y + TORCH_RADIUS + 1)
+    right = min(active_x + active_width, player.x + TORCH_RADIUS + 1)
+    for y in range(max(active_y, player.y - TORCH_RADIUS), bottom):
+        row = (y - active_y) * active_width - active_x
+        for x in range(max(active_x, player.x - TORCH_RADIUS), right):
+            if cells[row + x] & libtcod.MAP_IN_FOV:
+                lit.add((x, y))
+    return frozenset(lit)
+
+
+def update_visible_tiles(tiles):
+    # Show the tiles in FOV, every tile that went dark or got lit is dirty
+    global visible_tiles
+    dirty_tiles.update(tiles ^ visible_tiles)
+    visible_tiles = tiles
+
+
+def explore(cells):
+    # Everything in FOV becomes explored, the cells cover the active area
+    world_map.explore(active_x, active_y, active_width, active_height, cells, libtcod.MAP_IN_FOV)
+
+
+def mark_all_dirty():
+    # Forget what is on screen, the next render_all() repaints the whole map
+    global full_redraw, visible_tiles
+    full_redraw = True
+    visible_tiles = set()
+    dirty_tiles.clear()
+
+
+def render_map():
+    global full_redraw
+    if map_renderer == 'numpy':
+        render_map_numpy()
+        return
+    if full_redraw:
+        full_redraw = False
+        dirty_tiles.clear()
+        width, height = view_size()
+        for y in range(camera_y, camera_y + height):
+            for x in range(camera_x, camera_x + width):
+                render_tile(x, y)
+    else:
+        for (x, y) in dirty_tiles:
+            if in_view(x, y):
+                render_tile(x, y)
+        dirty_tiles.clear()
+
+
+def render_tile(x, y):
+    wall = world_map.get('block_sight', x, y)
+    visible = (x, y) in visible_tiles
+    screen_x = x - camera_x
+    screen_y = y - camera_y
+    if not visible:
+        # It's out of the players FoV, only draw if explored. Unexplored tiles are black (another part of the
+        # map may have been on this spot of the screen before the camera moved)
+        if world_map.get('explored', x, y):
+            if wall:
+                libtcod.console_set_char_background(con, screen_x, screen_y, color_dark_wall, libtcod.BKGND_SET)
+            else:
+                libtcod.console_set_char_background(con, screen_x, screen_y, color_dark_floor, libtcod.BKGND_SET)
+        else:
+            libtcod.console_set_char_background(con, screen_x, screen_y, libtcod.black, libtcod.BKGND_SET)
+    else:
+        # inside FOV
+        if wall:
+            libtcod.console_set_char_background(con, screen_x, screen_y, color_light_wall, libtcod.BKGND_SET)
+        else:
+            libtcod.console_set_char_background(con, screen_x, screen_y, color_light_floor, libtcod.BKGND_SET)
+
+
+def color_rgb(color):
+    return color.r, color.g, color.b
+
+
+def render_map_numpy():
+    # Paint the whole map background in one console_fill_background call. Produces the same pixels as render_tile()
+    global full_redraw
+    if not full_redraw and not dirty_tiles:
+        return
+    full_redraw = False
+    dirty_tiles.clear()
+
+    # The wall and explored planes of the part of the map in view, indexed [y, x] like the console
+    width, height = view_size()
+    wall_plane = numpy.frombuffer(world_map.region('block_sight', camera_x, camera_y, width, height),
+                                  dtype=numpy.uint8).reshape(height, width)
+    explored_plane = numpy.frombuffer(world_map.region('explored', camera_x, camera_y, width, height),
+                                      dtype=numpy.uint8).reshape(height, width)
+    visible = numpy.zeros((height, width), dtype=numpy.bool_)
+    in_sight = [(x - camera_x, y - camera_y) for (x, y) in visible_tiles if in_view(x, y)]
+    if in_sight:
+        xs, ys = zip(*in_sight)
+        visible[list(ys), list(xs)] = True
+
+    # 0 unexplored, 1 explored, 2 visible; walls use the upper half of the palette
+    index = numpy.where(visible, 2, explored_plane.astype(numpy.intc)) + 3 * wall_plane
+    palette = numpy.array([(0, 0, 0), color_rgb(color_dark_floor), color_rgb(color_light_floor),
+                           (0, 0, 0), color_rgb(color_dark_wall), color_rgb(color_light_wall)],
+                          dtype=numpy.intc)
+    colors = numpy.zeros((SCREEN_HEIGHT, SCREEN_WIDTH, 3), dtype=numpy.intc)
+    colors[:height, :width] = palette[index]
+    libtcod.console_fill_background(con, colors[..., 0].ravel(), colors[..., 1].ravel(), colors[..., 2].ravel())
+
+
 # Main render function
 def render_all():
-    global fov_recompute
+    update_fov()
+    move_camera()
 
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            wall = world_map[x][y].block_sight
-            visible = libtcod.map_is_in_fov(fov_map, x, y)
-            if not visible:
-                # It's out of the players FoV, only draw if explored
-                if world_map[x][y].explored:
-                    if wall:
-                        libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-                    # libtcod.console_put_char_ex(con, x, y, '#', color_dark_wall, libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(con, x, y, color_dark_floor, libtcod.BKGND_SET)
-                        # libtcod.console_put_char_ex(con, x, y, '.', color_dark_floor, libtcod.BKGND_SET)
-            else:
-                # inside FOV
-                if wall:
-                    libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-                # libtcod.console_put_char_ex(con, x, y, '#', color_light_wall, libtcod.dark_blue)
-                else:
-                    libtcod.console_set_char_background(con, x, y, color_light_floor, libtcod.BKGND_SET)
-                # libtcod.console_put_char_ex(con, x, y, '.', color_light_floor, libtcod.BKGND_SET)
-                map[x][y].explored = True
-
-    # draw all objects in the list
+    # Only repaint the map tiles that changed since the last frame
+    timed('map', render_map)
+    timed('objects', render_objects)
+    timed('panel', render_panel)
+
+
+def update_fov():
+    global fov_recompute
     if fov_recompute:
+        # recompute FOV if needed (the player moved or something)
         fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-    # Render all objects, and player last
-    for object in objects:
+        timed('fov', compute_fov)
+
+
+def compute_fov():
+    # Walking back and forth sees the same things again, so the tiles in FOV come from the cache when they can.
+    # They were explored when they were first seen, a cached field of view needs nothing else
+    global fov_tiles
+    activate_area()
+    key = (player.x, player.y, TORCH_RADIUS, world_map.version, active_x, active_y)
+    tiles = fov_cache.get(key)
+    if tiles is None:
+        libtcod.map_compute_fov(fov_map, player.x - active_x, player.y - active_y, TORCH_RADIUS, FOV_LIGHT_WALLS,
+                                FOV_ALGO)
+        cells = libtcod.map_get_cells(fov_map)
+        tiles = lit_tiles(cells)
+        fov_cache.put(key, tiles)
+        explore(cells)
+    fov_tiles = tiles
+    update_visible_tiles(tiles)
+
+
+def active_area(x, y):
+    # The chunks around the one (x, y) is in, as a rectangle of the map: (x, y, width, height)
+    size = world_map.chunk_size
+    left = max(0, (x // size - ACTIVE_CHUNKS) * size)
+    top = max(0, (y // size - ACTIVE_CHUNKS) * size)
+    right = min(world_map.width, (x // size + ACTIVE_CHUNKS + 1) * size)
+    bottom = min(world_map.height, (y // size + ACTIVE_CHUNKS + 1) * size)
+    return left, top, right - left, bottom - top
+
+
+def activate_area(force=False):
+    # Make the fov map (and so FOV and pathfinding) cover the active area around the player. It only changes when
+    # the player walks into another chunk, or for a new map when forced
+    global fov_map, chase_map, active_x, active_y, active_width, active_height
+    area = active_area(player.x, player.y)
+    if not force and fov_map is not None and area == (active_x, active_y, active_width, active_height):
+        return
+    if chase_map is not None:
+        libtcod.dijkstra_delete(chase_map)
+        chase_map = None
+    if fov_map is not None:
+        libtcod.map_delete(fov_map)
+    active_x, active_y, active_width, active_height = area
+    # all cells in one go
+    fov_map = libtcod.map_new(active_width, active_height)
+    libtcod.map_set_cells(fov_map, world_map.fov_cells(*area))
+
+
+def in_active_area(x, y):
+    return active_x <= x < active_x + active_width and active_y <= y < active_y + active_height
+
+
+def in_fov(x, y):
+    # The fov map isn't computed again for a cached field of view, the tiles in FOV are always up to date
+    return (x, y) in fov_tiles
+
+
+def view_size():
+    # How much of the map the view shows, all of it when it is smaller than the screen
+    return min(VIEW_WIDTH, world_map.width), min(VIEW_HEIGHT, world_map.height)
+
+
+def in_view(x, y):
+    return camera_x <= x < camera_x + VIEW_WIDTH and camera_y <= y < camera_y + VIEW_HEIGHT
+
+
+def move_camera():
+    # Keep the player in the middle of the view, without scrolling past the edges of the map. Everything in view
+    # is repainted when the camera moves
+    global camera_x, camera_y, full_redraw
+    x = max(0, min(player.x - VIEW_WIDTH // 2, world_map.width - VIEW_WIDTH))
+    y = max(0, min(player.y - VIEW_HEIGHT // 2, world_map.height - VIEW_HEIGHT))
+    if (x, y) != (camera_x, camera_y):
+        camera_x, camera_y = x, y
+        full_redraw = True
+
+
+def render_objects():
+    # Render all objects in view, and player last
+    for object in objects_in_view():
         if not object.is_player:
             object.draw()
     player.draw()
     # libtcod.console_print_frame(con, 10,10,10,10, clear=True, flag=libtcod.BKGND_DEFAULT, fmt="Derp")
     # blit the contents of "con" to the root console
-    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+    libtcod.console_blit(con, 0, 0, VIEW_WIDTH, VIEW_HEIGHT, screen, 0, 0)
+
+
+def objects_in_view():
+    return objects.in_rect(camera_x, camera_y, camera_x + VIEW_WIDTH - 1, camera_y + VIEW_HEIGHT - 1)
+
 
+def render_panel():
     # Prepare to render the GUI panel
     libtcod.console_set_default_background(panel, libtcod.black)
     libtcod.console_clear(panel)
 
-    # Show the player's status
-    y = 1
-    for (line, color) in game_msgs:
-        libtcod.console_set_default_foreground(panel, color)
-        libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
-        y += 1
+    # Show the player's status, or the profile in place of the messages
+    if show_profile and profiler:
+        render_profile()
+    else:
+        y = 1
+        for (line, color) in game_msgs:
+            libtcod.console_set_default_foreground(panel, color)
+            libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+            y += 1
     render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp, libtcod.light_red, libtcod.darker_red)
     render_bar(1, 2, BAR_WIDTH, 'XP', player.fighter.xp, LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR,
                libtcod.light_violet, libtcod.darker_violet)
@@ -826,7 +1131,37 @@ def render_all():
     # display names of objects under the mouse
     libtcod.console_set_default_foreground(panel, libtcod.light_gray)
     libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
-    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, screen, 0, PANEL_Y)
+
+
+def render_profile():
+    # Milliseconds per phase over the last frames, in two columns where the messages usually go
+    column_width = MSG_WIDTH // 2
+    libtcod.console_set_default_foreground(panel, libtcod.light_yellow)
+    for column in range(2):
+        libtcod.console_print_ex(panel, MSG_X + column * column_width, 1, libtcod.BKGND_NONE, libtcod.LEFT,
+                                 '%-8s %6s %6s %6s' % ('ms', 'p50', 'p95', 'max'))
+    libtcod.console_set_default_foreground(panel, libtcod.white)
+    for i, (phase, samples, p50, p95, worst) in enumerate(profiler.stats()[:2 * (MSG_HEIGHT - 1)]):
+        x = MSG_X + (i // (MSG_HEIGHT - 1)) * column_width
+        y = 2 + i % (MSG_HEIGHT - 1)
+        libtcod.console_print_ex(panel, x, y, libtcod.BKGND_NONE, libtcod.LEFT,
+                                 '%-8s %6.2f %6.2f %6.2f' % (phase, p50, p95, worst))
+
+
+def timed(phase, function, *args):
+    # Call the function, counting the time it takes towards the phase when profiling
+    if profiler:
+        return profiler.time(phase, function, *args)
+    return function(*args)
+
+
+def toggle_profile():
+    # Show or hide the profile, profiling starts the first time it is shown
+    global profiler, show_profile
+    if not profiler:
+        profiler = Profiler()
+    show_profile = not show_profile
 
 
 def player_move_or_attack(dx, dy):
@@ -838,8 +1173,8 @@ def player_move_or_attack(dx, dy):
 
     # Try to find an attackable object there
     target = None
-    for object in objects:
-        if object.fighter and object.x == x and object.y == y:
+    for object in objects.at(x, y):
+        if object.fighter:
             target = object
             break
 
@@ -878,6 +1213,7 @@ def monster_death(monster):
     monster.ai = None
     monster.name = 'remains of ' + monster.name
     monster.send_to_back()
+    scheduler.remove(monster)
 
 
 def cthulhu_death(monster):
@@ -892,6 +1228,7 @@ def cthulhu_death(monster):
     monster.ai = None
     monster.name = 'remains of ' + monster.name
     monster.send_to_back()
+    scheduler.remove(monster)
     game_state = 'victory'
 
 
@@ -900,8 +1237,9 @@ def closest_monster(max_range):
     closest_enemy = None
     closest_dist = max_range + 1  # start with slightly more than max range
 
-    for object in objects:
-        if object.fighter and not object.is_player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+    for object in objects.in_rect(player.x - TORCH_RADIUS, player.y - TORCH_RADIUS, player.x + TORCH_RADIUS,
+                                  player.y + TORCH_RADIUS):
+        if object.fighter and not object.is_player and in_fov(object.x, object.y):
             # calculate distance between this object and the player
             dist = player.distance_to(object)
             if dist < closest_dist:  # it's closer so remember it
@@ -914,17 +1252,23 @@ def target_tile(max_range=None):
     # Return the position of a tile left-clicked by the player and in the players FOV (optionally in range)
     # or (None,None) if right clicked
     global key, mouse
+    if headless:
+        return input_source.choose_tile(max_range)
     while True:
         # Render the screen this erases the inventory and shows the names of objects under the mouse
         libtcod.console_flush()
         libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
         render_all()
-        (x, y) = (mouse.cx, mouse.cy)
+        (x, y) = (mouse.cx + camera_x, mouse.cy + camera_y)
 
-        if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y)) and (
+        if (mouse.lbutton_pressed and in_fov(x, y)) and (
                         max_range is None or player.distance(x, y) <= max_range):
+            if recorder:
+                recorder.tile(turn_count, x, y)
             return x, y
         if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
+            if recorder:
+                recorder.tile(turn_count, None, None)
             return None, None  # Cancel if the player right clicked or pressed escape
 
 
@@ -935,8 +1279,8 @@ def target_monster(max_range=None):
         if x is None:  # Player cancelled
             return None
         # Return the first clicked monster
-        for obj in objects:
-            if obj.fighter and not obj.is_player and obj.x == x and obj.y == y:
+        for obj in objects.at(x, y):
+            if obj.fighter and not obj.is_player:
                 return obj
 
 
@@ -963,6 +1307,7 @@ def check_level_up():
                 player.fighter.base_power += 1
             elif choice == 2:
                 player.fighter.base_defense += 1
+            player.fighter.invalidate_stats()
 
 
 # ------------------ GUI functions
@@ -979,7 +1324,7 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
         libtcod.console_rect(panel, x, y, bar_width, 1, False, libtcod.BKGND_SCREEN)
     # Finally some centered text with the values
     libtcod.console_set_default_foreground(panel, libtcod.white)
-    libtcod.console_print_ex(panel, x + total_width / 2, y, libtcod.BKGND_NONE, libtcod.CENTER,
+    libtcod.console_print_ex(panel, x + total_width // 2, y, libtcod.BKGND_NONE, libtcod.CENTER,
                              name + ': ' + str(value) + '/' + str(maximum))
 
 
@@ -999,16 +1344,18 @@ def get_names_under_mouse():
     global mouse
 
     # return a string with the names of all objects under the mouse
-    (x, y) = (mouse.cx, mouse.cy)
+    (x, y) = (mouse.cx + camera_x, mouse.cy + camera_y)
     # create a list with the names of all objects under the mouse and in FOV
-    names = [obj.name for obj in objects
-             if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    names = [obj.name for obj in objects.at(x, y) if in_fov(obj.x, obj.y)]
     names = ', '.join(names)  # join the names, separated by commas
     return names.capitalize()
 
 
 def menu(header, options, width):
     if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options')
+    if headless:
+        # Nothing to draw on, let the scripted input pick an option
+        return input_source.choose(header, options)
     # Calculate total height of the header
     header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
     if header == '':
@@ -1043,9 +1390,11 @@ def menu(header, options, width):
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
     # Convert the ASCII code to an index; if it corresponds to an options, return it
     index = key.c - ord('a')
-    if 0 <= index < len(options):
-        return index
-    return None
+    if not 0 <= index < len(options):
+        index = None
+    if recorder:
+        recorder.menu(turn_count, index)
+    return index
 
 
 def inventory_menu(header):
@@ -1075,7 +1424,7 @@ def msgbox(text, width=50):
 def zombie_bite(self, target):
     if target.fighter:
         effect = Effect(name='zombie bite', duration=4, defense_mod=-1)
-        target.fighter.active_effects.append(effect)
+        target.fighter.add_effect(effect)
         message(target.name.capitalize() + ' is affected by ' + effect.name +
                 ', defense reduced by ' + str(effect.defense_mod) +
                 ' for ' + str(effect.duration) + ' turns.', libtcod.red)
@@ -1085,7 +1434,7 @@ def orc_berserk(self, target):
     if self.hp <= (self.max_hp / 3):
         effect = Effect(name='berserker rage', duration=10, power_mod=2, defense_mod=-1)
         message(self.owner.name.capitalize() + ' grows furious!', libtcod.red)
-        self.active_effects.append(effect)
+        self.add_effect(effect)
 
 
 def cast_heal(heal_amount):
@@ -1106,7 +1455,7 @@ def cast_lightning():
     # damage it
     message('A lightning bolt strikes the ' + monster.name + ' with a loud thunder! The damage is '
             + str(LIGHTNING_DAMAGE) + ' hit points.', libtcod.light_blue)
-    monster.fighter.take_damage(LIGHTNING_DAMAGE)
+    monster.fighter.take_damage(LIGHTNING_DAMAGE, 'lightning bolt')
 
 
 def cast_confuse():
@@ -1132,13 +1481,20 @@ def cast_fireball():
     for obj in objects:  # Damage everyone in range, including player
         if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
             message(obj.name.capitalize() + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points!', libtcod.orange)
-            obj.fighter.take_damage(FIREBALL_DAMAGE)
+            obj.fighter.take_damage(FIREBALL_DAMAGE, 'fireball')
 
 
 # ----------- Initialize functions ---------------
 
-def new_game():
-    global player, game_msgs, game_state, dungeon_lvl
+def new_game(seed=None):
+    global player, game_msgs, game_state, dungeon_lvl, turn_count
+    # every game gets a seed of it's own unless it is given one, everything random follows from it
+    if seed is None:
+        seed = libtcod.random_get_int(0, 0, 0x7fffffff)
+    seed_game(seed)
+    # the levels of a new game go to a temporary file until it is saved, the store of the last savegame is left
+    # alone until then
+    open_level_store(None)
 
     # Create object representing player
     fighter_component = Fighter(hp=100, defense=9, power=2, xp=0, death_function=player_death)
@@ -1153,10 +1509,9 @@ def new_game():
 
     # Start on dungeon lvl 1
     dungeon_lvl = 1
+    turn_count = 0
     # Generate map (at this point it's not drawn to screen)
-    make_map()
-    # bsp_make_map()
-    init_fov()
+    build_level()
 
     game_state = 'playing'
 
@@ -1173,52 +1528,229 @@ def new_game():
 
 
 def init_fov():
-    global fov_recompute, fov_map
+    global fov_recompute, fov_tiles
     fov_recompute = True
     # unexplored areas start black (which is the default background color)
     libtcod.console_clear(con)
-    # create fov_map according to generated map
-    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    mark_all_dirty()
+    # create fov_map according to generated map, around the player
+    fov_cache.clear()
+    fov_tiles = frozenset()
+    activate_area(force=True)
+
+
+def play_turn():
+    # Handle the current key and, if the player acted, let everyone else act. Returns the player's action
+    global turn_count
+    check_level_up()
+    # the key is recorded where it is used, after the level up menu, which is the order a replay asks for them in
+    if recorder and key.vk != libtcod.KEY_NONE:
+        recorder.key(turn_count, key)
+
+    # Erase objects at their old locations
+    for object in objects_in_view():
+        object.clear()
+
+    # Handle keys and exit if needed
+    player_action = handle_keys()
+
+    # let monsters whose time has come take their turn and update fighter effects
+    if game_state == 'playing' and player_action != 'didnt-take-turn':
+        wake_sleepers()
+        for actor in scheduler.advance(ACTION_TIME):
+            take_actor_turn(actor)
+        turn_count += 1
+        if turn_count % AUTOSAVE_INTERVAL == 0:
+            autosave()
+    return player_action
+
+
+def take_actor_turn(actor):
+    if actor.ai:
+        timed('ai', actor.ai.take_turn)
+    if actor.fighter:
+        timed('effects', actor.fighter.update_effects)
+    # stay scheduled as long as there is something left to do, unless it can doze off
+    if actor.ai or (actor.fighter and actor.fighter.active_effects):
+        if not (is_idle(actor) and put_to_sleep(actor)):
+            scheduler.add(actor, action_delay(actor))
+
+
+def is_idle(monster):
+    # A monster with nothing to hunt and no effects running, far away from the player
+    return (isinstance(monster.ai, BasicMonster) and monster.ai.target is None and
+            not monster.fighter.active_effects and monster.distance_to(player) > SLEEP_RADIUS)
+
+
+def room_chunks(room):
+    # The chunks of the map the room is in
+    size = world_map.chunk_size
+    return [(cx, cy) for cy in range(room.y1 // size, room.y2 // size + 1)
+            for cx in range(room.x1 // size, room.x2 // size + 1)]
+
+
+def room_at(x, y):
+    # The room the tile is in, None outside rooms. Only the rooms in the chunk of the tile are looked at, the
+    # index is made again when the level has other rooms
+    global room_index
+    if room_index[0] is not rooms:
+        index = {}
+        for room in rooms:
+            for key in room_chunks(room):
+                index.setdefault(key, []).append(room)
+        room_index = (rooms, index)
+    size = world_map.chunk_size
+    for room in room_index[1].get((x // size, y // size), ()):
+        if room.contains(x, y):
+            return room
+    return None
 
 
-def play_game():
+def put_to_sleep(monster):
+    # Stop scheduling the monster until the player comes near the room it is in.
+    # Monsters outside rooms (or in a room close to the player) stay awake
+    room = room_at(monster.x, monster.y)
+    if room is None or room.distance(player.x, player.y) <= WAKE_RADIUS:
+        return False
+    if room not in sleepers:
+        sleepers[room] = []
+        for key in room_chunks(room):
+            sleeping_rooms.setdefault(key, []).append(room)
+    sleepers[room].append(monster)
+    return True
+
+
+def wake_sleepers():
+    # Wake every monster sleeping in a room the player got close to. Such a room is in one of the chunks within
+    # WAKE_RADIUS of the player, the rooms in other chunks are not looked at
+    size = world_map.chunk_size
+    for cy in range((player.y - WAKE_RADIUS) // size, (player.y + WAKE_RADIUS) // size + 1):
+        for cx in range((player.x - WAKE_RADIUS) // size, (player.x + WAKE_RADIUS) // size + 1):
+            for room in list(sleeping_rooms.get((cx, cy), ())):
+                if room.distance(player.x, player.y) <= WAKE_RADIUS:
+                    wake_room(room)
+
+
+def wake_room(room):
+    # Schedule the monsters sleeping in the room again
+    for key in room_chunks(room):
+        sleeping_rooms[key].remove(room)
+        if not sleeping_rooms[key]:
+            del sleeping_rooms[key]
+    for monster in sleepers.pop(room):
+        if monster.ai:
+            scheduler.add(monster, action_delay(monster))
+
+
+def action_delay(obj):
+    # Game time until the object acts again, faster objects act more often
+    return ACTION_TIME * NORMAL_SPEED // obj.speed
+
+
+def init_scheduler():
+    # Schedule everything on the level that has an ai or effects to wear off, and nothing else
+    global scheduler, sleepers, sleeping_rooms
+    scheduler = Scheduler()
+    sleepers = {}
+    sleeping_rooms = {}
+    for obj in objects:
+        if obj.ai or (obj.fighter and obj.fighter.active_effects):
+            scheduler.add(obj, action_delay(obj))
+
+
+def play_headless(source, max_turns=None):
+    # Play without a window: keys come from the scripted input source and nothing is rendered.
+    # Stops when the game is over, the source runs out of keys or after max_turns keys
     global key, mouse
-
-    player_action = None
-
     mouse = libtcod.Mouse()
     key = libtcod.Key()
-    while not libtcod.console_is_window_closed():
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
-        render_all()
-        libtcod.console_flush()
+    turns = 0
+    while game_state == 'playing' and (max_turns is None or turns < max_turns):
+        # see what there is to see and level up before the next key comes in, like the window loop does when
+        # it renders the frame
+        update_fov()
         check_level_up()
+        if not source.fill_key(key):
+            break
+        turns += 1
+        if play_turn() == 'exit':
+            break
+    return turns
 
-        # Erase objects at their old locations
-        for object in objects:
-            object.clear()
 
-        # Handle keys and exit if needed
-        player_action = handle_keys()
+def play_game():
+    global key, mouse, autosaver
 
-        # let monsters take their turn and update fighter effects
-        if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
-                if object.fighter:
-                    object.fighter.update_effects()
+    player_action = None
 
-        if player_action == 'exit':
-            save_game()
-            break
-        if game_state == 'victory':
-            msgbox('Congratulations, you have beaten ' + GAMENAME + '!\n' +
-                   'I hope you enjoyed it!', 40)
-            break
+    mouse = libtcod.Mouse()
+    key = libtcod.Key()
+    autosaver = Autosaver(write_savegame, 'savegame')
+    start_level_pipeline()
+    start_profiler()
+    try:
+        while not libtcod.console_is_window_closed():
+            timed('events', libtcod.sys_check_for_event, libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
+            render_all()
+            timed('flush', libtcod.console_flush)
+
+            player_action = play_turn()
+            if profiler:
+                profiler.end_frame()
+
+            if player_action == 'exit':
+                # let a pending autosave finish first, so it can't overwrite this save
+                autosaver.close()
+                save_game()
+                break
+            if game_state == 'victory':
+                msgbox('Congratulations, you have beaten ' + GAMENAME + '!\n' +
+                       'I hope you enjoyed it!', 40)
+                break
+    finally:
+        autosaver.close()
+        autosaver = None
+        stop_level_pipeline()
+        stop_recording()
+        stop_profiler()
+
+
+def start_profiler():
+    global profiler
+    if PROFILE and not profiler:
+        profiler = Profiler()
+
+
+def stop_profiler():
+    # Leave the statistics of the session behind, so builds can be compared
+    global profiler, show_profile
+    if profiler:
+        profiler.dump(PROFILE_FILE)
+        profiler = None
+        show_profile = False
+
+
+def start_recording(savegame_filename=None):
+    # Record the inputs of the game about to be played, see replay.py. A game continued from a savegame is
+    # recorded together with the savegame and it's level store, so the levels the player goes back to are the same
+    global recorder
+    if not RECORD_INPUT:
+        return
+    savegame = levels = None
+    if savegame_filename:
+        with open(savegame_filename, 'rb') as f:
+            savegame = f.read()
+        if os.path.exists(savegame_filename + LEVEL_STORE_SUFFIX):
+            with open(savegame_filename + LEVEL_STORE_SUFFIX, 'rb') as f:
+                levels = f.read()
+    recorder = Recorder('recording', game_seed, savegame, levels)
+
+
+def stop_recording():
+    global recorder
+    if recorder:
+        recorder.close()
+        recorder = None
 
 
 def main_menu():
@@ -1237,6 +1769,7 @@ def main_menu():
 
         if choice == 0:  # new game
             new_game()
+            start_recording()
             play_game()
         elif choice == 1:  # load game
             try:
@@ -1244,6 +1777,7 @@ def main_menu():
             except:
                 msgbox('\n No saved game to load.\n', 30)
                 continue
+            start_recording('savegame')
             play_game()
         elif choice == 2:  # quit
             break
@@ -1251,57 +1785,489 @@ def main_menu():
 
 def next_level():
     # Advance to the next level
-    global dungeon_lvl
-    message('You take a moment to rest and recover your strength.', libtcod.light_violet)
-    player.fighter.heal(player.fighter.max_hp / 2)  # Heal the player by 50%
+    if dungeon_lvl + 1 not in level_store:
+        # only a new level gets a rest, going back down to one the player has seen doesn't heal
+        message('You take a moment to rest and recover your strength.', libtcod.light_violet)
+        player.fighter.heal(player.fighter.max_hp / 2)  # Heal the player by 50%
 
     message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', libtcod.red)
-    dungeon_lvl += 1
-    make_map()
-    init_fov()
+    change_level(dungeon_lvl + 1)
+    autosave()
 
 
-def save_game():
-    # open an empty shelve (possibly overwriting an old one) to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(
-        player)  # index of player in objects list, cant save player object directly because already in objects
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)  # same as with player
-    file['dungeon_lvl'] = dungeon_lvl
-    file.close()
-
-
-def load_game():
-    # Open the previously saved shelve and load game data
-    global world_map, objects, player, game_msgs, game_state, stairs, dungeon_lvl
-    savefile = shelve.open('savegame', 'r')
-    world_map = savefile['map']
-    dungeon_lvl = savefile['dungeon_lvl']
-    objects = savefile['objects']
-    player = objects[savefile['player_index']]
-    stairs = objects[savefile['stairs_index']]
-    game_msgs = savefile['game_msgs']
-    game_state = savefile['game_state']
-    savefile.close()
+def previous_level():
+    # Climb back up to the level above, which is just like the player left it
+    message('You climb back up the stairs.', libtcod.light_violet)
+    change_level(dungeon_lvl - 1)
+    autosave()
 
+
+def change_level(level):
+    # Leave the level for another one. The level left is paged out to the level store, the player arrives on
+    # the stairs up when going down and on the stairs down when going up
+    global dungeon_lvl
+    going_down = level > dungeon_lvl
+    store_level()
+    dungeon_lvl = level
+    build_level(going_down)
+
+
+# Functions and component classes that can be stored in a savegame. Renaming any of these needs a new savegame
+# version, new fields need a default in the class defaults for older saves
+for function in (player_death, monster_death, cthulhu_death, zombie_bite, orc_berserk,
+                 cast_heal, cast_lightning, cast_confuse, cast_fireball):
+    savefile.register_function(function)
+savefile.register_class(Object, ('_x', '_y', 'char', 'name', 'color', 'blocks', 'always_visible', 'is_player',
+                                 'level', 'speed', 'fighter', 'ai', 'item', 'equipment', 'container', 'controller'),
+                        entity=True)
+savefile.register_class(Fighter, ('base_max_hp', 'hp', 'base_defense', 'base_power', 'xp', 'death_function',
+                                  'attack_effect_function', 'active_effects', 'killed_by'))
+savefile.register_class(Effect, ('name', 'duration', 'power_mod', 'defense_mod', 'max_hp_mod'))
+savefile.register_class(Item, ('use_function', 'param'))
+savefile.register_class(Equipment, ('slot', 'is_equipped', 'power_bonus', 'defense_bonus', 'max_hp_bonus'))
+savefile.register_class(Container, ('size', 'inventory'))
+savefile.register_class(Controller, ())
+savefile.register_class(PlayerAi, ())
+savefile.register_class(BasicMonster, ('target',))
+savefile.register_class(ConfusedMonster, ('old_ai', 'num_turns'))
+
+
+def all_entities():
+    # Every object of the level: the ones on the map, in their order, followed by everything carried
+    entities = list(objects)
+    for obj in entities:
+        if obj.container:
+            entities.extend(obj.container.inventory)
+    return entities
+
+
+def link_components(obj):
+    # Tell the components of a loaded object who owns them (owners are not stored in savegames)
+    for component in (obj.fighter, obj.ai, obj.item, obj.equipment, obj.container, obj.controller):
+        if component:
+            component.owner = obj
+    if obj.fighter:
+        obj.fighter.invalidate_stats()
+    if isinstance(obj.ai, ConfusedMonster) and obj.ai.old_ai:
+        obj.ai.old_ai.owner = obj
+
+
+def snapshot_game():
+    # Copy everything a savegame needs. This is quick and the copy is private, so it can be written out later
+    # (on another thread) while the game goes on. The map is copied by chunk, only the chunks changed since the
+    # last snapshot, the writer puts the planes together
+    entities, (messages,) = savefile.snapshot(all_entities(), [game_msgs])
+    return {'game_seed': game_seed, 'dungeon_lvl': dungeon_lvl, 'game_state': game_state, 'game_msgs': messages,
+            'world_map': world_map.snapshot(),
+            'num_objects': len(objects), 'entities': entities,
+            # index of player and stairs in objects list, they are saved as part of it
+            'player_index': objects.index(player), 'stairs_index': objects.index(stairs),
+            'upstairs_index': objects.index(upstairs) if upstairs else None,
+            'rooms': [(room.x1, room.y1, room.x2, room.y2) for room in rooms]}
+
+
+# Savegame layouts by version: 2 was the first, 3 added the rooms at the end, 4 the game seed at the start and 5 the
+# stairs up after the stairs. load_game() reads all of them
+def write_savegame(snapshot, filename):
+    # Write into a temporary file and rename it over the old savegame, so a crash never leaves a broken one
+    temp_filename = filename + '.tmp'
+    f = open(temp_filename, 'wb')
+    try:
+        writer = savefile.Writer(f)
+        writer.header()
+        writer.uint(snapshot['game_seed'])
+        writer.uint(snapshot['dungeon_lvl'])
+        writer.string(snapshot['game_state'])
+        writer.value(snapshot['game_msgs'])
+        saved_map = snapshot['world_map']
+        writer.uint(saved_map.width)
+        writer.uint(saved_map.height)
+        for plane in PLANES:
+            writer.bits(saved_map.plane(plane))
+        writer.uint(snapshot['num_objects'])
+        writer.entities(snapshot['entities'])
+        writer.uint(snapshot['player_index'])
+        writer.uint(snapshot['stairs_index'])
+        writer.value(snapshot['upstairs_index'])
+        writer.value(snapshot['rooms'])
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    replace_file(temp_filename, filename)
+
+
+def replace_file(source, destination):
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:  # python 2, rename only replaces files atomically on posix
+        if os.name != 'posix' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def save_game(filename='savegame'):
+    # Write the game into a new savegame (possibly overwriting an old one), and the levels the player left next
+    # to it
+    write_savegame(snapshot_game(), filename)
+    save_levels(filename + LEVEL_STORE_SUFFIX)
+
+
+def autosave():
+    # Hand a snapshot to the autosaver, when there is one. The levels the player left go next to the savegame
+    # first (here, the level store isn't shared with the autosave thread), so the savegame it writes always has
+    # the levels that go with it
+    if autosaver:
+        save_levels(autosaver.filename + LEVEL_STORE_SUFFIX)
+        autosaver.save(snapshot_game())
+
+
+def save_levels(filename):
+    # Only the levels that changed since the last save are written, unless the game goes to a new savegame
+    global level_store
+    if level_store.filename == filename:
+        level_store.flush()
+    else:
+        moved = level_store.copy(filename)
+        level_store.close()
+        level_store = moved
+
+
+def open_level_store(filename):
+    # Keep the levels the player leaves in filename (a temporary file when it is None)
+    global level_store
+    if level_store is not None:
+        level_store.close()
+    level_store = LevelStore(filename, game_seed)
+
+
+def load_game(filename='savegame'):
+    # Load the game data from a savegame
+    global world_map, objects, player, game_msgs, game_state, stairs, upstairs, dungeon_lvl, rooms, turn_count
+    f = open(filename, 'rb')
+    try:
+        reader = savefile.Reader(f)
+        version = reader.header()
+        # savegames from before the game seed get a new one, it only decides the levels still to come
+        seed_game(reader.uint() if version >= 4 else libtcod.random_get_int(0, 0, 0x7fffffff))
+        dungeon_lvl = reader.uint()
+        game_state = reader.string()
+        game_msgs = reader.value()
+        world_map = WorldMap(reader.uint(), reader.uint())
+        for plane in PLANES:
+            world_map.load_plane(plane, reader.bits())
+        num_objects = reader.uint()
+        entities = reader.read_entities()
+        for obj in entities:
+            link_components(obj)
+        objects = ObjectList(entities[:num_objects])
+        player = objects[reader.uint()]
+        stairs = objects[reader.uint()]
+        upstairs_index = reader.value() if version >= 5 else None
+        upstairs = objects[upstairs_index] if upstairs_index is not None else None
+        rooms = [Rect(x1, y1, x2 - x1, y2 - y1) for (x1, y1, x2, y2) in reader.value()] if version >= 3 else []
+    finally:
+        f.close()
+
+    # the levels left in this game, the ones that are missing (an old savegame) are made again from their seeds
+    open_level_store(filename + LEVEL_STORE_SUFFIX)
+    turn_count = 0
+    init_fov()
+    init_scheduler()
+    # the level is replayed from the start of the ai stream, it's position isn't saved
+    seed_streams(level_seed(dungeon_lvl), ('ai',))
+    prepare_next_level()
+
+
+# ----------- LEVEL GENERATION -----------
+
+def generate_level(seed):
+    # Make the map of dungeon_lvl from the level's own streams, so the level comes out the same no matter where
+    # (or in which process) it is made. Messages from making it (orcs picking up their swords) are dropped
+    global game_msgs
+    seed_streams(seed, ('mapgen', 'spawn', 'loot'))
+    messages, game_msgs = game_msgs, []
+    try:
+        make_map()
+        # bsp_make_map()
+    finally:
+        game_msgs = messages
+
+
+def build_level(going_down=True):
+    # Set up dungeon_lvl: as the player left it if they were there before, otherwise using the level the worker
+    # made in the background if it is ready
+    seed = level_seed(dungeon_lvl)
+    if not restore_level(going_down):
+        data = level_pipeline and level_pipeline.take(dungeon_lvl, seed)
+        if data:
+            unpack_level(data)
+        else:
+            generate_level(seed)
     init_fov()
+    init_scheduler()
+    seed_streams(seed, ('ai',))
+    prepare_next_level()
+
+
+def prepare_next_level():
+    # Have the worker start on the level below, unless the player has been there
+    if level_pipeline and dungeon_lvl + 1 not in level_store:
+        level_pipeline.request(dungeon_lvl + 1, level_seed(dungeon_lvl + 1))
+
+
+def pregenerate_level(level, seed):
+    # Runs in the level worker process, it's globals are it's own
+    global player, dungeon_lvl
+    player = Object(0, 0, '@', 'Player', libtcod.white, blocks=True)  # stand-in, only it's position is kept
+    dungeon_lvl = level
+    generate_level(seed)
+    return pack_level()
+
+
+def pack_level():
+    # The level without the player, in the savegame format
+    f = io.BytesIO()
+    writer = savefile.Writer(f)
+    writer.header()
+    writer.uint(world_map.width)
+    writer.uint(world_map.height)
+    for plane in PLANES:
+        writer.bits(world_map.plane(plane))
+    write_level_objects(writer)
+    writer.uint(player.x)
+    writer.uint(player.y)
+    return f.getvalue()
+
+
+def unpack_level(data):
+    # Swap in a level made by pack_level(), with the player placed where the level wants it
+    global world_map
+    reader = savefile.Reader(io.BytesIO(data))
+    reader.header()
+    world_map = WorldMap(reader.uint(), reader.uint())
+    for plane in PLANES:
+        world_map.load_plane(plane, reader.bits())
+    read_level_objects(reader)
+    player.x = reader.uint()
+    player.y = reader.uint()
+
+
+def write_level_objects(writer):
+    # The objects of the level and everything they carry, but not the player or what the player carries
+    level_objects = [obj for obj in objects if obj is not player]
+    entities = list(level_objects)
+    for obj in entities:
+        if obj.container:
+            entities.extend(obj.container.inventory)
+    writer.uint(len(level_objects))
+    writer.entities(entities)
+    # where the player goes in the objects list (it decides the drawing order), and the stairs
+    writer.uint(objects.index(player))
+    writer.uint(objects.index(stairs))
+    writer.value(objects.index(upstairs) if upstairs else None)
+    writer.value([(room.x1, room.y1, room.x2, room.y2) for room in rooms])
+
+
+def read_level_objects(reader):
+    # Swap in the objects written by write_level_objects(), with the player among them
+    global objects, stairs, upstairs, rooms
+    num_objects = reader.uint()
+    entities = reader.read_entities()
+    for obj in entities:
+        link_components(obj)
+    level_objects = entities[:num_objects]
+    level_objects.insert(reader.uint(), player)
+    objects = ObjectList(level_objects)
+    stairs = objects[reader.uint()]
+    upstairs_index = reader.value()
+    upstairs = objects[upstairs_index] if upstairs_index is not None else None
+    rooms = [Rect(x1, y1, x2 - x1, y2 - y1) for (x1, y1, x2, y2) in reader.value()]
+
+
+def store_level():
+    # Page the level out to the level store. Monsters that were after the player forget about them
+    for obj in objects:
+        ai = obj.ai.old_ai if isinstance(obj.ai, ConfusedMonster) else obj.ai
+        if isinstance(ai, BasicMonster) and ai.target is player:
+            ai.target = None
+    f = io.BytesIO()
+    writer = savefile.Writer(f)
+    writer.header()
+    write_level_objects(writer)
+    level_store.put(dungeon_lvl, world_map, f.getvalue())
+
+
+def restore_level(going_down):
+    # Page dungeon_lvl back in from the level store, with the player on the stairs they came by. False if the
+    # level isn't there
+    global world_map
+    stored = level_store.get(dungeon_lvl)
+    if stored is None:
+        return False
+    world_map, data = stored
+    reader = savefile.Reader(io.BytesIO(data))
+    reader.header()
+    read_level_objects(reader)
+    arrival = upstairs if going_down else stairs
+    player.x = arrival.x
+    player.y = arrival.y
+    return True
+
+
+def start_level_pipeline():
+    global level_pipeline
+    if not PREGENERATE_LEVELS or headless:
+        return
+    try:
+        level_pipeline = LevelPipeline(pregenerate_level)
+    except (OSError, ImportError):  # no process support here, levels are made when they are needed
+        return
+    prepare_next_level()
+
+
+def stop_level_pipeline():
+    global level_pipeline
+    if level_pipeline:
+        level_pipeline.close()
+        level_pipeline = None
 
 
 # ----------- INITIALIZE AND MAIN LOOP -----------
 
-# Set up the consoles
-# libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False)
-# libtcod.console_credits()
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+def init_consoles():
+    global con, panel
+    # Set up the consoles
+    # libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False)
+    # libtcod.console_credits()
+    con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    # Set up GUI panel
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+    # Set max fps
+    libtcod.sys_set_fps(LIMIT_FPS)
+
+
+# ----------- RANDOM NUMBERS -----------
+
+def seed_game(seed):
+    # Everything random in a game follows from it's seed, which is kept in the savegame
+    global game_seed
+    game_seed = seed
+
+
+def derive_seed(seed, *names):
+    # A seed for something of it's own (a level, a stream), the same on every platform and python version
+    return zlib.crc32('/'.join(str(part) for part in (seed,) + names).encode('utf-8')) & 0x7fffffff
+
+
+def level_seed(level):
+    return derive_seed(game_seed, 'level', level)
+
+
+def seed_streams(seed, names):
+    # (Re)create the named random streams from a seed. Each kind of decision draws from it's own stream so
+    # they don't disturb each other: mapgen (layout), spawn (monsters), loot (items) and ai (monsters and effects)
+    for name in names:
+        if name in rng:
+            libtcod.random_delete(rng[name])
+        rng[name] = libtcod.random_new_from_seed(derive_seed(seed, name))
+
+
+def init_headless(source):
+    # Run without a window: consoles are off-screen only and menus, targeting and keys come from the source
+    global con, panel, screen, headless, input_source
+    headless = True
+    input_source = source
+    if con is None:
+        con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+        panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+        screen = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+
+
+# Off-screen consoles for the map and the GUI panel, created by init_consoles() or init_headless()
+con = None
+panel = None
+
+# The console render_all() draws the frame on: the window (the root console, 0) or an off-screen stand-in
+# when headless, so frames can be rendered (and timed) without a window
+screen = 0
+
+# Who acts when, rebuilt for every level
+scheduler = Scheduler()
+
+# Monster and item prototypes by name with their spawn chance tables, loaded by load_prototypes(), and the
+# spawn tables made for each dungeon level
+monster_types = None
+item_types = None
+spawn_tables = {}
+
+# Taken tiles of the level bsp_make_map() is laying out rooms on
+room_mask = None
+
+# Rooms of the level, and the monsters sleeping in each room until the player comes near. sleeping_rooms has the
+# rooms with sleepers by chunk, room_index all the rooms by chunk (see room_at())
+rooms = []
+sleepers = {}
+sleeping_rooms = {}
+room_index = (None, {})
+
+# The stairs back up of the level (None on the first level), and the levels the player has left
+upstairs = None
+level_store = None
+
+# The worker process making the level below ahead of time (None when levels are made on demand)
+level_pipeline = None
+
+# Player turns taken since the game started or was loaded, and the background saver while playing
+turn_count = 0
+autosaver = None
+
+# Records the inputs of the game being played, None when not recording
+recorder = None
+
+# Times the phases of every frame when profiling (None otherwise), and if the overlay on the panel is showing
+profiler = None
+show_profile = False
+
+# The game's seed and it's random streams by name, see seed_streams()
+game_seed = 0
+rng = {}
+
+# Headless runs have no window, input_source then stands in for the keyboard and mouse
+headless = False
+input_source = None
+
+# Map tiles that need repainting on the next frame and the tiles shown lit on screen
+dirty_tiles = set()
+visible_tiles = set()
+full_redraw = True
+
+# libtcod map of the active area for FOV and pathfinding, made by activate_area(), the tiles in the players FOV
+# and the fields of view seen lately
+fov_map = None
+fov_tiles = frozenset()
+fov_cache = FovCache(FOV_CACHE_SIZE)
+
+# The part of the map the fov map covers: the chunks around the player
+active_x = 0
+active_y = 0
+active_width = 0
+active_height = 0
 
-# Set up GUI panel
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+# Map position of the top left corner of the view
+camera_x = 0
+camera_y = 0
 
-# Set max fps
-libtcod.sys_set_fps(LIMIT_FPS)
-main_menu()
+# Shared dijkstra map monsters use to hunt the player, and the player position it was computed for
+chase_map = None
+chase_origin = None
+
+# Fall back to the per-tile renderer when NumPy is not installed
+map_renderer = MAP_RENDERER if numpy_available else 'tiles'
+
+if __name__ == '__main__':
+    init_consoles()
+    main_menu()
@@ -0,0 +1,78 @@
+class ObjectList(list):
+    """The list of objects on the map, also hashed by tile so position lookups don't scan the whole list.
+
+    Objects report their own moves through moved(), everything else is kept in sync by append/insert/remove."""
+
+    def __init__(self, objects=()):
+        list.__init__(self)
+        self.tiles = {}
+        for obj in objects:
+            self.append(obj)
+
+    def __reduce__(self):
+        # Pickle as a plain list of objects, the tile hash is rebuilt on load
+        return ObjectList, (list(self),)
+
+    def append(self, obj):
+        list.append(self, obj)
+        self.tiles.setdefault((obj.x, obj.y), []).append(obj)
+
+    def insert(self, index, obj):
+        list.insert(self, index, obj)
+        bucket = self.tiles.setdefault((obj.x, obj.y), [])
+        if index == 0:
+            bucket.insert(0, obj)  # keep the order of the list on the tile, so it is still drawn first there
+        else:
+            bucket.append(obj)
+
+    def extend_front(self, objects):
+        # Same as insert(0, obj) for each of the objects in turn, so the last one ends up first, but in one go
+        objects = list(objects)
+        self[0:0] = objects[::-1]
+        for obj in objects:
+            self.tiles.setdefault((obj.x, obj.y), []).insert(0, obj)
+
+    def remove(self, obj):
+        list.remove(self, obj)
+        self._unhash(obj, obj.x, obj.y)
+
+    def moved(self, obj, old_x, old_y):
+        # Called by an object after it's position changed, objects that are not on the map are ignored
+        if self._unhash(obj, old_x, old_y):
+            self.tiles.setdefault((obj.x, obj.y), []).append(obj)
+
+    def at(self, x, y):
+        # Return a list of the objects on the tile
+        return list(self.tiles.get((x, y), ()))
+
+    def in_rect(self, x1, y1, x2, y2):
+        # Return a list of the objects inside the inclusive rectangle, going through the tiles of the rectangle or
+        # the occupied tiles, whichever there are less of
+        found = []
+        if (x2 - x1 + 1) * (y2 - y1 + 1) < len(self.tiles):
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    found.extend(self.tiles.get((x, y), ()))
+        else:
+            for (x, y), bucket in self.tiles.items():
+                if x1 <= x <= x2 and y1 <= y <= y2:
+                    found.extend(bucket)
+        return found
+
+    def is_blocked(self, x, y):
+        for obj in self.tiles.get((x, y), ()):
+            if obj.blocks:
+                return True
+        return False
+
+    def _unhash(self, obj, x, y):
+        bucket = self.tiles.get((x, y))
+        if not bucket:
+            return False
+        for i, other in enumerate(bucket):
+            if other is obj:
+                del bucket[i]
+                if not bucket:
+                    del self.tiles[(x, y)]
+                return True
+        return False
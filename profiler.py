@@ -0,0 +1,74 @@
+"""Where the time of a frame goes, phase by phase.
+
+Code being profiled calls Profiler.time() (or adds its own measurements) and the profiler sums them up per
+phase until end_frame(), which makes one sample per phase. The last PROFILE_WINDOW samples of every phase are
+kept, so the statistics follow what the game is doing now."""
+import collections
+import csv
+import json
+import time
+
+from constants import PROFILE_WINDOW
+
+# The best clock there is: perf_counter on python 3, time() on python 2
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def percentile(ordered, fraction):
+    # Nearest rank percentile of an already sorted list
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Profiler(object):
+    """Rolling per-phase timings"""
+
+    def __init__(self, window=PROFILE_WINDOW):
+        self.window = window
+        self.samples = collections.OrderedDict()  # phase -> deque of seconds, in the order phases first showed up
+        self.frame = {}  # phase -> seconds spent in it during the current frame
+        self.frames = 0
+
+    def time(self, phase, function, *args):
+        # Call the function and add the time it took to the phase
+        start = clock()
+        try:
+            return function(*args)
+        finally:
+            self.add(phase, clock() - start)
+
+    def add(self, phase, seconds):
+        self.frame[phase] = self.frame.get(phase, 0) + seconds
+
+    def end_frame(self):
+        # Every phase that ran during the frame gets a sample of it's total time
+        for phase, seconds in self.frame.items():
+            if phase not in self.samples:
+                self.samples[phase] = collections.deque(maxlen=self.window)
+            self.samples[phase].append(seconds)
+        self.frame = {}
+        self.frames += 1
+
+    def stats(self):
+        # (phase, samples, p50, p95, max) for every phase, times in milliseconds
+        rows = []
+        for phase, samples in self.samples.items():
+            ordered = sorted(samples)
+            rows.append((phase, len(ordered), percentile(ordered, 0.5) * 1000, percentile(ordered, 0.95) * 1000,
+                         ordered[-1] * 1000))
+        return rows
+
+    def dump(self, filename):
+        # Write the statistics as CSV if the file name ends in .csv, as JSON otherwise
+        rows = self.stats()
+        if filename.endswith('.csv'):
+            with open(filename, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(('phase', 'samples', 'p50_ms', 'p95_ms', 'max_ms'))
+                for row in rows:
+                    writer.writerow(row)
+        else:
+            with open(filename, 'w') as f:
+                json.dump({'frames': self.frames,
+                           'phases': collections.OrderedDict(
+                               (phase, {'samples': count, 'p50_ms': p50, 'p95_ms': p95, 'max_ms': worst})
+                               for (phase, count, p50, p95, worst) in rows)}, f, indent=1)
@@ -0,0 +1,99 @@
+"""Input recordings, to replay a game exactly.
+
+A recording starts with a header: magic, format version, the game seed and, for a game continued from a
+savegame, the savegame itself and the level store that goes with it. Then comes every input the game consumed, with the turn it came in: key
+presses, menu answers and picked tiles. Events are appended and flushed as they happen, so a crash leaves a
+recording of everything up to it. Numbers are varints, like in savegames."""
+import savefile
+
+MAGIC = b'RLRC'
+VERSION = 2  # 2 added the level store
+
+# event tags
+KEY, MENU, TILE = range(3)
+
+
+class RecordingError(Exception):
+    pass
+
+
+class Recorder(object):
+    """Writes the inputs of one game into a new recording file"""
+
+    def __init__(self, filename, seed, savegame=None, levels=None):
+        self.f = open(filename, 'wb')
+        self.writer = savefile.Writer(self.f)
+        self.f.write(MAGIC)
+        self.writer.uint(VERSION)
+        self.writer.uint(seed)
+        # 0 for a new game (or no level store), otherwise the length plus one
+        for data in (savegame, levels):
+            if data is None:
+                self.writer.uint(0)
+            else:
+                self.writer.uint(len(data) + 1)
+                self.f.write(data)
+        self.f.flush()
+
+    def event(self, tag, turn, *values):
+        self.writer.uint(tag)
+        self.writer.uint(turn)
+        for value in values:
+            self.writer.uint(value)
+        self.f.flush()
+
+    def key(self, turn, key):
+        self.event(KEY, turn, key.vk, key.c, int(bool(key.lalt)))
+
+    def menu(self, turn, index):
+        self.event(MENU, turn, 0 if index is None else index + 1)
+
+    def tile(self, turn, x, y):
+        if x is None:
+            self.event(TILE, turn, 0)
+        else:
+            self.event(TILE, turn, 1, x, y)
+
+    def close(self):
+        self.f.close()
+
+
+class Recording(object):
+    """Reads a recording back, one event at a time"""
+
+    def __init__(self, f):
+        self.reader = savefile.Reader(f)
+        try:
+            if self.reader.read(len(MAGIC)) != MAGIC:
+                raise RecordingError('Not a recording')
+            version = self.reader.uint()
+            if not 1 <= version <= VERSION:
+                raise RecordingError('Unsupported recording version %d' % version)
+            self.seed = self.reader.uint()
+            size = self.reader.uint()
+            self.savegame = self.reader.read(size - 1) if size else None
+            self.levels = None
+            if version >= 2:
+                size = self.reader.uint()
+                self.levels = self.reader.read(size - 1) if size else None
+        except savefile.SaveFormatError:
+            raise RecordingError('Recording is truncated')
+
+    def next_event(self):
+        # Returns (tag, turn, values), or None at the end. An event cut short by a crash counts as the end
+        try:
+            tag = self.reader.uint()
+            turn = self.reader.uint()
+            if tag == KEY:
+                values = (self.reader.uint(), self.reader.uint(), self.reader.uint())
+            elif tag == MENU:
+                values = (self.reader.uint(),)
+            elif tag == TILE:
+                values = (self.reader.uint(),)
+                if values[0]:
+                    values += (self.reader.uint(), self.reader.uint())
+            else:
+                raise RecordingError('Unknown event tag %d' % tag)
+        except savefile.SaveFormatError:
+            return None
+        return tag, turn, values
@@ -0,0 +1,135 @@
+"""Monster and item definitions, read from monsters.config.
+
+The config is parsed with the libtcod parser, which is slow enough to notice at startup, so the definitions are
+also written to a binary cache next to it (savefile values) together with the modification time of the config.
+As long as the config is not touched the cache is read instead. main.py compiles the definitions into
+prototype objects."""
+import os
+import struct
+
+import libtcodpy as libtcod
+import savefile
+
+MAGIC = b'RLMC'
+VERSION = 1
+
+# Property names and types of the two kinds of definitions, in the order the cache stores them. Properties a
+# definition leaves out are None. The type names (char, color...) are keywords of the parser and can't be used
+# as property names
+PROPERTIES = {
+    'monster': (('ch', libtcod.TYPE_CHAR), ('col', libtcod.TYPE_COLOR), ('hp', libtcod.TYPE_INT),
+                ('defense', libtcod.TYPE_INT), ('power', libtcod.TYPE_INT), ('xp', libtcod.TYPE_INT),
+                ('death', libtcod.TYPE_STRING), ('attack_effect', libtcod.TYPE_STRING),
+                ('chances', libtcod.TYPE_LIST | libtcod.TYPE_INT), ('carries', libtcod.TYPE_STRING)),
+    'item': (('ch', libtcod.TYPE_CHAR), ('col', libtcod.TYPE_COLOR), ('use', libtcod.TYPE_STRING),
+             ('param', libtcod.TYPE_INT), ('slot', libtcod.TYPE_STRING), ('power_bonus', libtcod.TYPE_INT),
+             ('defense_bonus', libtcod.TYPE_INT), ('max_hp_bonus', libtcod.TYPE_INT),
+             ('chances', libtcod.TYPE_LIST | libtcod.TYPE_INT)),
+}
+MANDATORY = ('ch', 'col')
+KINDS = ('monster', 'item')
+
+
+class RegistryError(Exception):
+    pass
+
+
+def text(value):
+    # The parser hands out bytes on python 3
+    return value.decode('utf-8') if isinstance(value, bytes) and bytes is not str else value
+
+
+def c_string(value):
+    # ...and wants bytes for every name and filename, a python 3 str would reach it as a wide string
+    return value.encode('utf-8') if not isinstance(value, bytes) else value
+
+
+class Listener(object):
+    """Collects the definitions as the libtcod parser reads them"""
+
+    def __init__(self):
+        self.definitions = dict((kind, []) for kind in KINDS)
+        self.current = None
+        self.errors = []
+
+    def new_struct(self, struct, name):
+        kind = text(libtcod.struct_get_name(struct))
+        self.current = (kind, text(name), {})
+        return True
+
+    def new_flag(self, name):
+        return True
+
+    def new_property(self, name, typ, value):
+        if typ == libtcod.TYPE_COLOR:
+            value = libtcod.Color(value.r, value.g, value.b)  # the parser reuses the memory
+        self.current[2][text(name)] = text(value) if typ in (libtcod.TYPE_CHAR, libtcod.TYPE_STRING) else value
+        return True
+
+    def end_struct(self, struct, name):
+        kind, name, values = self.current
+        fields = tuple(values.get(field) for (field, typ) in PROPERTIES[kind])
+        self.definitions[kind].append((name, fields))
+        self.current = None
+        return True
+
+    def error(self, message):
+        self.errors.append(text(message))
+        return True
+
+
+def parse(filename):
+    # {kind: [(name, (property values in PROPERTIES order))]} from a config file, in the order of the file
+    parser = libtcod.parser_new()
+    for kind in KINDS:
+        struct_type = libtcod.parser_new_struct(parser, c_string(kind))
+        for (field, typ) in PROPERTIES[kind]:
+            if typ & libtcod.TYPE_LIST:
+                libtcod.struct_add_list_property(struct_type, c_string(field), typ & 0xff, False)
+            else:
+                libtcod.struct_add_property(struct_type, c_string(field), typ, field in MANDATORY)
+    listener = Listener()
+    try:
+        libtcod.parser_run(parser, c_string(filename), listener)
+    finally:
+        libtcod.parser_delete(parser)
+    if listener.errors:
+        raise RegistryError('%s: %s' % (filename, '; '.join(listener.errors)))
+    return listener.definitions
+
+
+def write_cache(filename, mtime, definitions):
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        writer = savefile.Writer(f)
+        writer.uint(VERSION)
+        f.write(struct.pack('<d', mtime))
+        for kind in KINDS:
+            writer.value(definitions[kind])
+
+
+def read_cache(filename, mtime):
+    # The cached definitions, None if there is no usable cache for a config modified at mtime
+    try:
+        with open(filename, 'rb') as f:
+            reader = savefile.Reader(f)
+            if reader.read(len(MAGIC)) != MAGIC or reader.uint() != VERSION:
+                return None
+            if struct.unpack('<d', reader.read(8))[0] != mtime:
+                return None
+            return dict((kind, [(name, tuple(fields)) for (name, fields) in reader.value()]) for kind in KINDS)
+    except (IOError, OSError, savefile.SaveFormatError):
+        return None
+
+
+def load(config, cache):
+    # The definitions in the config, from the cache when it is up to date
+    mtime = os.path.getmtime(config)
+    definitions = read_cache(cache, mtime)
+    if definitions is None:
+        definitions = parse(config)
+        try:
+            write_cache(cache, mtime, definitions)
+        except (IOError, OSError):
+            pass  # a read-only game directory only costs the parsing every time
+    return definitions
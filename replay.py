@@ -0,0 +1,119 @@
+"""Replay a recorded game headless, as fast as it runs (nothing is rendered and there is no fps limit).
+
+    python replay.py recording
+
+feeds the recorded inputs through the same code as the real game. A crash in the recorded game happens again
+in the replay, and a fixed recording makes a repeatable workload for profiling turn processing."""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import main
+from constants import LEVEL_STORE_SUFFIX
+from headless import ScriptedInput
+from profiler import Profiler
+from recording import Recording, RecordingError, KEY, MENU, TILE
+
+EVENT_NAMES = {KEY: 'key', MENU: 'menu answer', TILE: 'tile'}
+
+
+class Replayer(ScriptedInput):
+    """Answers keys, menus and targeting from a recording"""
+
+    def __init__(self, recording):
+        ScriptedInput.__init__(self)
+        self.recording = recording
+
+    def next_event(self, tag):
+        # The values of the next event, None when the recording is over. The event has to be the kind the game
+        # is asking for, on the same turn, otherwise the replay no longer follows the recorded game
+        event = self.recording.next_event()
+        if event is None:
+            return None
+        event_tag, turn, values = event
+        if event_tag != tag or turn != main.turn_count:
+            raise RecordingError('Replay out of sync: the game wants a %s on turn %d, the recording has a %s on '
+                                 'turn %d' % (EVENT_NAMES[tag], main.turn_count, EVENT_NAMES[event_tag], turn))
+        return values
+
+    def fill_key(self, key):
+        # headless games have no frames, every key counts as one when profiling
+        if main.profiler:
+            main.profiler.end_frame()
+        values = self.next_event(KEY)
+        if values is None:
+            return False
+        key.vk, key.c, key.lalt = values[0], values[1], bool(values[2])
+        key.pressed = True
+        return True
+
+    def choose(self, header, options):
+        values = self.next_event(MENU)
+        if not values or not values[0]:
+            return None
+        return values[0] - 1
+
+    def choose_tile(self, max_range):
+        values = self.next_event(TILE)
+        if not values or not values[0]:
+            return None, None
+        return values[1], values[2]
+
+
+def start(recording):
+    # Set up the game the recording starts from: a new game from the seed or the savegame it continued. Returns
+    # the directory the savegame went to, it holds the level store the game uses until it is over
+    if recording.savegame is None:
+        main.new_game(recording.seed)
+        return None
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'savegame')
+    with open(filename, 'wb') as f:
+        f.write(recording.savegame)
+    if recording.levels is not None:
+        with open(filename + LEVEL_STORE_SUFFIX, 'wb') as f:
+            f.write(recording.levels)
+    try:
+        main.load_game(filename)
+    except Exception:
+        shutil.rmtree(directory)
+        raise
+    return directory
+
+
+def replay(filename, max_turns=None, profile=None):
+    # Play a recording through, returns (keys replayed, seconds taken). With a profile file name the time spent
+    # in the turn phases (ai, effects) is written to it, one sample per key
+    with open(filename, 'rb') as f:
+        recording = Recording(f)
+        source = Replayer(recording)
+        main.init_headless(source)
+        directory = start(recording)
+        if profile:
+            main.profiler = Profiler()
+        started = time.time()
+        try:
+            turns = main.play_headless(source, max_turns)
+        finally:
+            if profile:
+                main.profiler.end_frame()
+                main.profiler.dump(profile)
+                main.profiler = None
+            if directory:
+                main.open_level_store(None)  # let go of the store before it's directory goes
+                shutil.rmtree(directory)
+        return turns, time.time() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded game without a window.')
+    parser.add_argument('recording', nargs='?', default='recording')
+    parser.add_argument('--turns', type=int, help='stop after this many keys')
+    parser.add_argument('--profile', help='write the time taken by the turn phases to this .json or .csv file')
+    args = parser.parse_args()
+
+    turns, seconds = replay(args.recording, args.turns, args.profile)
+    print('%d keys in %.2f s (%.0f keys/s), dungeon level %d, turn %d, %s' % (
+        turns, seconds, turns / max(seconds, 1e-9), main.dungeon_lvl, main.turn_count, main.game_state))
@@ -0,0 +1,411 @@
+"""Compact, versioned binary savegames.
+
+A savegame is a header (magic and format version) followed by values written in the order the game chooses.
+Tile planes are stored as packed bits, objects and their components as typed records holding the fields their
+class registered, and functions by their registered name, so refactoring code doesn't break old saves as long as
+the registered names stay the same. Every class is written with the names of it's fields the first time it
+appears, fields missing from an older save get the default of the class (see Record) and fields no longer
+registered are skipped.
+
+Values are tagged: integers are zigzag varints, strings are length prefixed utf-8, and class and function
+names are written once and referred to by number afterwards."""
+import binascii
+import struct
+
+try:  # NumPy is optional, it is only used to speed things up
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+import libtcodpy as libtcod
+
+try:
+    integer_types = (int, long)
+except NameError:  # python 3
+    integer_types = (int,)
+
+MAGIC = b'RLSV'
+VERSION = 5  # goes up whenever the layout of a savegame changes, see main.write_savegame()
+MIN_VERSION = 2  # the oldest savegame that can still be read, the game decides what to do with older layouts
+
+# value tags
+NONE, FALSE, TRUE, INT, FLOAT, STRING, LIST, TUPLE, COLOR, FUNCTION, RECORD, ENTITY = range(12)
+
+_functions = {}  # name -> function
+_function_names = {}  # function -> name
+_classes = {}  # name -> (class, fields)
+_class_names = {}  # class -> name
+_entity_classes = set()
+
+
+class SaveFormatError(Exception):
+    pass
+
+
+def register_function(function, name=None):
+    # Functions stored in components (death functions, item uses...) must be registered to be saved
+    name = name or function.__name__
+    _functions[name] = function
+    _function_names[function] = name
+
+
+def lookup_function(name):
+    # The function registered under the name, None if there is none
+    return _functions.get(name)
+
+
+def register_class(cls, fields, entity=False):
+    # Instances of the class are saved as records of the given fields. Entities (objects on the map or in an
+    # inventory) are saved once in the entity table and referenced by number everywhere else
+    name = cls.__name__
+    _classes[name] = (cls, tuple(fields))
+    _class_names[cls] = name
+    if entity:
+        _entity_classes.add(cls)
+
+
+class Record(object):
+    """Base of the saved game classes. They keep their fields in __slots__ instead of a dict per instance, and
+    go through __getstate__ and __setstate__ to be saved and loaded.
+
+    The state is a dict of field values. __setstate__ sets the class defaults before the state, so fields a
+    savegame doesn't have (older saves, owners that are never saved) still exist afterwards."""
+    __slots__ = ()
+    defaults = {}
+
+    def __getstate__(self):
+        state = {}
+        for cls in self.__class__.__mro__:
+            for field in getattr(cls, '__slots__', ()):
+                if hasattr(self, field):
+                    state[field] = getattr(self, field)
+        return state
+
+    def __setstate__(self, state):
+        for field, value in self.defaults.items():
+            setattr(self, field, value)
+        for field, value in state.items():
+            setattr(self, field, value)
+
+
+class _Blank:
+    pass
+
+
+def _blank(cls):
+    # An instance that skipped __init__, it's fields are filled in by the reader
+    try:
+        return cls.__new__(cls)
+    except AttributeError:  # old-style class
+        obj = _Blank()
+        obj.__class__ = cls
+        return obj
+
+
+def _restore(obj, state):
+    # Give a blank instance it's fields, through __setstate__ if the class has one
+    setstate = getattr(obj, '__setstate__', None)
+    if setstate is not None:
+        setstate(state)
+    else:
+        for field, value in state.items():
+            setattr(obj, field, value)
+    return obj
+
+
+# bytearray.translate() tables between tiles and the digits of a binary number
+_TILE_DIGITS = bytes(bytearray([ord('0')] + [ord('1')] * 255))
+_DIGIT_TILES = bytes(bytearray(1 if value == ord('1') else 0 for value in range(256)))
+
+
+def pack_bits(plane):
+    # 8 tiles per byte, lowest bit first. Without NumPy the plane is read as one big binary number, tile i being
+    # bit i, so the work is done by int() and not by a loop in python
+    if numpy_available:
+        tiles = numpy.frombuffer(bytes(plane), dtype=numpy.uint8)
+        return bytearray(numpy.packbits(tiles != 0, bitorder='little').tobytes())
+    size = (len(plane) + 7) // 8
+    if not size:
+        return bytearray()
+    n = int(bytes(bytearray(plane).translate(_TILE_DIGITS)[::-1]), 2)
+    return bytearray(binascii.unhexlify('%0*x' % (2 * size, n)))[::-1]
+
+
+def unpack_bits(packed, length):
+    if numpy_available:
+        bits = numpy.unpackbits(numpy.frombuffer(bytes(packed), dtype=numpy.uint8), bitorder='little')
+        return bytearray(bits[:length].tobytes())
+    if not packed:
+        return bytearray(length)
+    n = int(binascii.hexlify(bytes(bytearray(packed)[::-1])), 16)
+    digits = bytearray(format(n, '0%db' % (8 * len(packed))).encode('ascii'))
+    return digits[::-1][:length].translate(_DIGIT_TILES)
+
+
+def snapshot(entities, values=()):
+    """Copy the entities, and any other values that refer to them, keeping only the registered fields.
+
+    The copies share nothing mutable with the game, so another thread can write them out while play goes on.
+    Returns the copied entities and the copied values."""
+    copies = {}
+    for entity in entities:
+        copies[entity] = _blank(entity.__class__)
+
+    def copy(value):
+        if value is None or isinstance(value, (bool, float, bytes, type(u'')) + integer_types):
+            return value
+        elif isinstance(value, list):
+            return [copy(item) for item in value]
+        elif isinstance(value, tuple):
+            return tuple(copy(item) for item in value)
+        elif isinstance(value, libtcod.Color):
+            return libtcod.Color(value.r, value.g, value.b)
+        elif value in _function_names:
+            return value
+        elif value.__class__ in _entity_classes:
+            if value not in copies:
+                raise SaveFormatError('%r is not in the entity table' % value)
+            return copies[value]
+        elif value.__class__ in _class_names:
+            return copy_fields(value, _blank(value.__class__))
+        raise SaveFormatError('Can not save %r' % value)
+
+    def copy_fields(obj, into):
+        return _restore(into, dict((field, copy(getattr(obj, field, None)))
+                                   for field in _classes[_class_names[obj.__class__]][1]))
+
+    for entity in entities:
+        copy_fields(entity, copies[entity])
+    return [copies[entity] for entity in entities], [copy(value) for value in values]
+
+
+class Writer(object):
+    """Streams a savegame into a binary file object"""
+
+    def __init__(self, f):
+        self.f = f
+        self.names = {}
+        self.class_ids = {}
+        self.entity_ids = {}
+
+    def header(self):
+        self.f.write(MAGIC)
+        self.f.write(struct.pack('<H', VERSION))
+
+    def uint(self, n):
+        out = bytearray()
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+        self.f.write(out)
+
+    def int(self, n):
+        self.uint(n * 2 if n >= 0 else -n * 2 - 1)
+
+    def string(self, s):
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        self.uint(len(s))
+        self.f.write(s)
+
+    def name(self, name):
+        # Names are written out the first time only, afterwards by their number
+        if name in self.names:
+            self.uint(self.names[name] + 1)
+        else:
+            self.names[name] = len(self.names)
+            self.uint(0)
+            self.string(name)
+
+    def class_name(self, cls):
+        # Like name(), but the first time the fields the class saves follow it's name
+        name = _class_names[cls]
+        if name in self.class_ids:
+            self.uint(self.class_ids[name] + 1)
+        else:
+            self.class_ids[name] = len(self.class_ids)
+            self.uint(0)
+            self.string(name)
+            fields = _classes[name][1]
+            self.uint(len(fields))
+            for field in fields:
+                self.string(field)
+
+    def bits(self, plane):
+        self.uint(len(plane))
+        self.f.write(pack_bits(plane))
+
+    def value(self, value):
+        if value is None:
+            self.uint(NONE)
+        elif value is True or value is False:
+            self.uint(TRUE if value else FALSE)
+        elif isinstance(value, integer_types):
+            self.uint(INT)
+            self.int(value)
+        elif isinstance(value, float):
+            self.uint(FLOAT)
+            self.f.write(struct.pack('<d', value))
+        elif isinstance(value, (bytes, type(u''))):
+            self.uint(STRING)
+            self.string(value)
+        elif isinstance(value, (list, tuple)):
+            self.uint(LIST if isinstance(value, list) else TUPLE)
+            self.uint(len(value))
+            for item in value:
+                self.value(item)
+        elif isinstance(value, libtcod.Color):
+            self.uint(COLOR)
+            self.f.write(struct.pack('<BBB', value.r, value.g, value.b))
+        elif value in _function_names:
+            self.uint(FUNCTION)
+            self.name(_function_names[value])
+        elif value.__class__ in _entity_classes:
+            if value not in self.entity_ids:
+                raise SaveFormatError('%r is not in the entity table' % value)
+            self.uint(ENTITY)
+            self.uint(self.entity_ids[value])
+        elif value.__class__ in _class_names:
+            self.uint(RECORD)
+            self.record(value)
+        else:
+            raise SaveFormatError('Can not save %r' % value)
+
+    def record(self, obj):
+        self.class_name(obj.__class__)
+        self.fields(obj)
+
+    def fields(self, obj):
+        for field in _classes[_class_names[obj.__class__]][1]:
+            self.value(getattr(obj, field, None))
+
+    def entities(self, entities):
+        # The class of every entity comes first so the reader can create them all before references appear
+        for entity in entities:
+            self.entity_ids[entity] = len(self.entity_ids)
+        self.uint(len(entities))
+        for entity in entities:
+            self.class_name(entity.__class__)
+        for entity in entities:
+            self.fields(entity)
+
+
+class Reader(object):
+    """Reads back a savegame written by Writer, in the same order"""
+
+    def __init__(self, f):
+        self.f = f
+        self.names = []
+        self.classes = []
+        self.entities = []
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) != n:
+            raise SaveFormatError('Savegame is truncated')
+        return data
+
+    def header(self):
+        if self.read(len(MAGIC)) != MAGIC:
+            raise SaveFormatError('Not a savegame')
+        version = struct.unpack('<H', self.read(2))[0]
+        if not MIN_VERSION <= version <= VERSION:
+            raise SaveFormatError('Unsupported savegame version %d' % version)
+        return version
+
+    def uint(self):
+        n = 0
+        shift = 0
+        while True:
+            byte = bytearray(self.read(1))[0]
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def int(self):
+        n = self.uint()
+        return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+    def string(self):
+        data = self.read(self.uint())
+        if bytes is str:  # python 2 strings are bytes already
+            return data
+        return data.decode('utf-8')
+
+    def name(self):
+        number = self.uint()
+        if number == 0:
+            self.names.append(self.string())
+            return self.names[-1]
+        return self.names[number - 1]
+
+    def bits(self):
+        length = self.uint()
+        return unpack_bits(bytearray(self.read((length + 7) // 8)), length)
+
+    def value(self):
+        tag = self.uint()
+        if tag == NONE:
+            return None
+        elif tag == FALSE:
+            return False
+        elif tag == TRUE:
+            return True
+        elif tag == INT:
+            return self.int()
+        elif tag == FLOAT:
+            return struct.unpack('<d', self.read(8))[0]
+        elif tag == STRING:
+            return self.string()
+        elif tag == LIST or tag == TUPLE:
+            items = [self.value() for i in range(self.uint())]
+            return items if tag == LIST else tuple(items)
+        elif tag == COLOR:
+            return libtcod.Color(*struct.unpack('<BBB', self.read(3)))
+        elif tag == FUNCTION:
+            name = self.name()
+            if name not in _functions:
+                raise SaveFormatError('Unknown function ' + name)
+            return _functions[name]
+        elif tag == ENTITY:
+            return self.entities[self.uint()]
+        elif tag == RECORD:
+            return self.record()
+        raise SaveFormatError('Unknown value tag %d' % tag)
+
+    def class_fields(self):
+        # Returns the class and the names of the fields as they were saved
+        number = self.uint()
+        if number == 0:
+            name = self.string()
+            if name not in _classes:
+                raise SaveFormatError('Unknown class ' + name)
+            fields = [self.string() for i in range(self.uint())]
+            self.classes.append((_classes[name][0], fields))
+            return self.classes[-1]
+        return self.classes[number - 1]
+
+    def fields(self, obj, saved_fields):
+        registered = _classes[_class_names[obj.__class__]][1]
+        state = {}
+        for field in saved_fields:
+            value = self.value()
+            if field in registered:
+                state[field] = value
+        _restore(obj, state)
+
+    def record(self):
+        cls, saved_fields = self.class_fields()
+        obj = _blank(cls)
+        self.fields(obj, saved_fields)
+        return obj
+
+    def read_entities(self):
+        classes = [self.class_fields() for i in range(self.uint())]
+        self.entities = [_blank(cls) for (cls, saved_fields) in classes]
+        for entity, (cls, saved_fields) in zip(self.entities, classes):
+            self.fields(entity, saved_fields)
+        return self.entities
@@ -0,0 +1,47 @@
+import heapq
+import itertools
+
+
+class Scheduler(object):
+    """Decides who acts when: a heap of (next action time, order added, actor).
+
+    Actors are woken only when their time has come, so idle objects (items, corpses, stairs) cost nothing.
+    Removing an actor is lazy, it's entry is skipped when it comes up."""
+
+    def __init__(self):
+        self.time = 0
+        self.heap = []
+        self.entries = {}  # actor -> it's live heap entry
+        self.counter = itertools.count()
+
+    def __contains__(self, actor):
+        return actor in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, actor, delay=0):
+        # Wake the actor delay time units from now, replacing any earlier schedule
+        if actor in self.entries:
+            self.entries[actor][2] = None
+        entry = [self.time + delay, next(self.counter), actor]
+        self.entries[actor] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, actor):
+        entry = self.entries.pop(actor, None)
+        if entry is not None:
+            entry[2] = None
+
+    def advance(self, duration):
+        # Move the clock forward and yield every actor that is due, in order. A yielded actor is no longer
+        # scheduled, add() it again to give it another turn
+        end = self.time + duration
+        while self.heap and self.heap[0][0] <= end:
+            time, order, actor = heapq.heappop(self.heap)
+            if actor is None:
+                continue
+            del self.entries[actor]
+            self.time = time
+            yield actor
+        self.time = end
@@ -0,0 +1,196 @@
+"""Play many headless games with an automated player and report statistics.
+
+    python simulate.py --games 1000 --processes 8 --seed 1
+
+Every game gets its own seed (the base seed plus the game number) and the games are spread over a process pool."""
+import argparse
+import json
+import multiprocessing
+import random
+import time
+
+import main
+from headless import ScriptedInput
+
+# Movement keys by direction, the same ones handle_keys() understands
+MOVE_KEYS = {(0, 1): 's', (0, -1): 'w', (1, 0): 'd', (-1, 0): 'a',
+             (1, 1): 'c', (1, -1): 'e', (-1, -1): 'q', (-1, 1): 'z'}
+
+HEAL_BELOW = 0.4  # drink a potion below this fraction of max hp
+SCROLL_RANGE = 4  # throw offensive scrolls at monsters this close
+
+
+class AutoPlayer(ScriptedInput):
+    """A simple bot: drinks potions when hurt, uses scrolls on monsters, fights what it sees,
+    picks up items and otherwise heads for the stairs."""
+
+    def __init__(self, seed=0):
+        ScriptedInput.__init__(self)
+        self.random = random.Random(seed)  # the bot's own, so it doesn't disturb the game's streams
+        self.menu_answer = None
+        self.tile_answer = (None, None)
+        self.turn = 0
+        self.level_log = []  # (dungeon level, turn reached, character level, xp) for every level reached
+
+    def next_key(self):
+        self.turn += 1
+        if not self.level_log or self.level_log[-1][0] != main.dungeon_lvl:
+            self.level_log.append((main.dungeon_lvl, self.turn, main.player.level, main.player.fighter.xp))
+        return self.decide()
+
+    def decide(self):
+        player = main.player
+        fighter = player.fighter
+        monsters = [obj for obj in main.objects if obj.fighter and not obj.is_player and
+                    main.in_fov(obj.x, obj.y)]
+        monsters.sort(key=player.distance_to)
+
+        if fighter.hp < fighter.max_hp * HEAL_BELOW and self.use_item('healing potion', 'greater healing potion'):
+            return 'i'
+        if monsters and player.distance_to(monsters[0]) <= SCROLL_RANGE:
+            target = monsters[0]
+            if self.use_item('scroll of lightning bolt', 'scroll of fireball', 'scroll of confusion'):
+                self.tile_answer = (target.x, target.y)
+                return 'i'
+            return self.step_towards(target.x, target.y)
+        if monsters:
+            return self.step_towards(monsters[0].x, monsters[0].y)
+
+        for obj in main.objects.at(player.x, player.y):
+            if obj.item and len(player.container.inventory) < player.container.size:
+                return 'g'
+        items = [obj for obj in main.objects if obj.item and main.in_fov(obj.x, obj.y)]
+        if items and len(player.container.inventory) < player.container.size:
+            items.sort(key=player.distance_to)
+            return self.step_towards(items[0].x, items[0].y)
+
+        if (player.x, player.y) == (main.stairs.x, main.stairs.y):
+            return '<'
+        return self.step_towards(main.stairs.x, main.stairs.y)
+
+    def use_item(self, *names):
+        # Prepare the inventory menu answer for the first carried item with one of the names
+        for index, obj in enumerate(main.player.container.inventory):
+            if obj.name in names:
+                self.menu_answer = index
+                return True
+        return False
+
+    def step_towards(self, x, y):
+        # First step of an A* path, or a random step if there is no path
+        step = None
+        if main.in_active_area(x, y):
+            step = main.path_step(main.player.x, main.player.y, x, y)
+        if step is None:
+            dx = self.random.randint(-1, 1)
+            dy = self.random.randint(-1, 1)
+        else:
+            dx = step[0] - main.player.x
+            dy = step[1] - main.player.y
+        return MOVE_KEYS.get((dx, dy), 'w')
+
+    def choose(self, header, options):
+        if self.menu_answer is not None:
+            answer, self.menu_answer = self.menu_answer, None
+            return answer
+        if options:
+            # level up: alternate between the stats
+            return main.player.level % len(options)
+        return None
+
+    def choose_tile(self, max_range):
+        answer, self.tile_answer = self.tile_answer, (None, None)
+        return answer
+
+
+def simulate_game(args):
+    # Play one full game, runs in a worker process
+    seed, max_turns = args
+    policy = AutoPlayer(seed)
+    main.init_headless(policy)
+    main.new_game(seed)
+    start = time.time()
+    turns = main.play_headless(policy, max_turns)
+    seconds = time.time() - start
+    if main.game_state == 'dead':
+        cause = main.player.fighter.killed_by or 'unknown'
+    elif main.game_state == 'victory':
+        cause = 'victory'
+    else:
+        cause = 'turn limit'
+    return {'seed': seed, 'turns': turns, 'seconds': seconds, 'result': main.game_state, 'cause': cause,
+            'deepest_level': main.dungeon_lvl, 'character_level': main.player.level, 'levels': policy.level_log}
+
+
+def aggregate(games):
+    total_turns = sum(game['turns'] for game in games)
+    total_seconds = sum(game['seconds'] for game in games)
+    depths = {}
+    causes = {}
+    for game in games:
+        depths[game['deepest_level']] = depths.get(game['deepest_level'], 0) + 1
+        causes[game['cause']] = causes.get(game['cause'], 0) + 1
+
+    # average character level and xp on arrival at each dungeon level
+    arrivals = {}
+    for game in games:
+        for (dungeon_lvl, turn, character_level, xp) in game['levels']:
+            arrivals.setdefault(dungeon_lvl, []).append((turn, character_level, xp))
+    xp_curve = []
+    for dungeon_lvl in sorted(arrivals):
+        rows = arrivals[dungeon_lvl]
+        xp_curve.append({'dungeon_level': dungeon_lvl, 'games': len(rows),
+                         'turn': float(sum(row[0] for row in rows)) / len(rows),
+                         'character_level': float(sum(row[1] for row in rows)) / len(rows),
+                         'xp': float(sum(row[2] for row in rows)) / len(rows)})
+
+    return {'games': len(games),
+            'deepest_level': {'max': max(depths), 'mean': float(sum(g['deepest_level'] for g in games)) / len(games),
+                              'histogram': dict((str(level), count) for level, count in sorted(depths.items()))},
+            'causes': causes,
+            'xp_curve': xp_curve,
+            'turns': total_turns,
+            'turns_per_second': total_turns / max(total_seconds, 1e-9)}
+
+
+def print_report(stats, wall_seconds):
+    print('%d games, %d turns in %.1f s (%.0f turns/s per process, %.0f turns/s overall)' % (
+        stats['games'], stats['turns'], wall_seconds, stats['turns_per_second'], stats['turns'] / wall_seconds))
+    print('deepest level: max %d, mean %.2f' % (stats['deepest_level']['max'], stats['deepest_level']['mean']))
+    for level, count in sorted(stats['deepest_level']['histogram'].items(), key=lambda item: int(item[0])):
+        print('  level %3s: %d' % (level, count))
+    print('outcome:')
+    for cause, count in sorted(stats['causes'].items(), key=lambda item: -item[1]):
+        print('  %-20s %d' % (cause, count))
+    print('arrival on each dungeon level (mean turn, character level, xp):')
+    for row in stats['xp_curve']:
+        print('  level %3d: %6.0f %5.2f %7.1f  (%d games)' % (
+            row['dungeon_level'], row['turn'], row['character_level'], row['xp'], row['games']))
+
+
+def run(games, processes=None, seed=0, max_turns=5000):
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = list(pool.imap_unordered(simulate_game, [(seed + i, max_turns) for i in range(games)]))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate games with an automated player.')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, defaults to the cpu count')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game, the others count up from it')
+    parser.add_argument('--turns', type=int, default=5000, help='turn limit per game')
+    parser.add_argument('--json', help='also write the statistics and every game to this file')
+    args = parser.parse_args()
+
+    start = time.time()
+    results = run(args.games, args.processes, args.seed, args.turns)
+    stats = aggregate(results)
+    print_report(stats, time.time() - start)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'stats': stats, 'games': sorted(results, key=lambda game: game['seed'])}, f, indent=1)
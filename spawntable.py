@@ -0,0 +1,44 @@
+import libtcodpy as libtcod
+
+
+class AliasTable(object):
+    """Draws one of a fixed list of options in proportion to their integer weights, in constant time.
+
+    This is Vose's alias method in whole numbers: every option gets a column of height total weight, filled up
+    to it's weight times the number of options and topped with some other option (it's alias). A draw picks a
+    column and a height, so the outcome depends only on the random stream and the order of the options."""
+
+    def __init__(self, options, weights):
+        # options with no weight can never be drawn, so they are left out
+        pairs = [(option, weight) for (option, weight) in zip(options, weights) if weight > 0]
+        self.options = [option for (option, weight) in pairs]
+        count = len(pairs)
+        self.total = sum(weight for (option, weight) in pairs)
+        self.heights = [weight * count for (option, weight) in pairs]
+        self.aliases = list(range(count))
+        small = [i for i in range(count) if self.heights[i] < self.total]
+        large = [i for i in range(count) if self.heights[i] >= self.total]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            # the column of less is topped up with more, which gives away that much of it's own
+            self.aliases[less] = more
+            self.heights[more] -= self.total - self.heights[less]
+            if self.heights[more] < self.total:
+                small.append(more)
+            else:
+                large.append(more)
+        for i in small + large:
+            self.heights[i] = self.total  # whatever is left fills it's own column exactly
+
+    def __len__(self):
+        return len(self.options)
+
+    def draw(self, stream):
+        # One option drawn with the libtcod random stream, None if there is nothing to draw
+        if not self.options:
+            return None
+        column = libtcod.random_get_int(stream, 0, len(self.options) - 1)
+        if libtcod.random_get_int(stream, 0, self.total - 1) < self.heights[column]:
+            return self.options[column]
+        return self.options[self.aliases[column]]
@@ -0,0 +1,63 @@
+"""Reading the monster and item definitions of monsters.config, with and without the cache.
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m unittest tests.test_registry
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import registry
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'monsters.config')
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        # the shipped config in a directory of it's own, so there is no cache next to it
+        self.directory = tempfile.mkdtemp()
+        self.config = os.path.join(self.directory, 'monsters.config')
+        self.cache = os.path.join(self.directory, 'monsters.cache')
+        shutil.copy2(CONFIG, self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_shipped_config(self):
+        definitions = registry.parse(self.config)
+        self.assertEqual([name for (name, fields) in definitions['monster']],
+                         ['zombie', 'orc', 'troll', 'ogre', 'dragon', 'cthulhu'])
+        self.assertEqual(len(definitions['item']), 8)
+        name, fields = definitions['monster'][1]
+        values = dict(zip([field for (field, typ) in registry.PROPERTIES['monster']], fields))
+        self.assertEqual((values['ch'], values['hp'], values['carries']), ('o', 20, 'orcish sword'))
+        self.assertEqual((values['col'].r, values['col'].g, values['col'].b), (0x3f, 0x7f, 0x3f))
+        self.assertEqual(list(values['chances']), [50, 1, 60, 2, 70, 3])
+
+    def test_load_without_cache(self):
+        self.assertFalse(os.path.exists(self.cache))
+        definitions = registry.load(self.config, self.cache)
+        self.assertTrue(os.path.exists(self.cache))
+        self.assertEqual(len(definitions['monster']), 6)
+        self.assertEqual(len(definitions['item']), 8)
+
+    def test_cache_matches_config(self):
+        parsed = registry.load(self.config, self.cache)
+        cached = registry.read_cache(self.cache, os.path.getmtime(self.config))
+        self.assertEqual([name for (name, fields) in cached['item']], [name for (name, fields) in parsed['item']])
+        self.assertEqual([fields[2:] for (name, fields) in cached['monster']],
+                         [fields[2:] for (name, fields) in parsed['monster']])
+
+    def test_changed_config_is_parsed_again(self):
+        registry.load(self.config, self.cache)
+        mtime = os.path.getmtime(self.config) + 10
+        os.utime(self.config, (mtime, mtime))
+        self.assertIsNone(registry.read_cache(self.cache, mtime))
+        self.assertEqual(len(registry.load(self.config, self.cache)['monster']), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Recording games and replaying them headless, replay.py has to end up in the game that was recorded.
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m unittest tests.test_replay
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import libtcodpy as libtcod
+import main
+import replay
+from constants import LEVEL_STORE_SUFFIX, LEVEL_UP_BASE, LEVEL_UP_FACTOR
+from headless import ScriptedInput
+from recording import Recorder
+
+
+class RecordedInput(ScriptedInput):
+    # Answers menus like the window does, which records the answer
+    def choose(self, header, options):
+        index = ScriptedInput.choose(self, header, options)
+        if main.recorder:
+            main.recorder.menu(main.turn_count, index)
+        return index
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def summary():
+    fighter = main.player.fighter
+    return (main.dungeon_lvl, main.turn_count, main.game_state, main.player.x, main.player.y, main.player.level,
+            fighter.hp, fighter.max_hp, fighter.power, fighter.defense, fighter.xp)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'recording')
+        main.init_headless(RecordedInput('wasdqezc', repeat=True))
+        main.mouse = libtcod.Mouse()
+        main.new_game(1)
+
+    def tearDown(self):
+        main.stop_recording()
+        main.open_level_store(None)
+        shutil.rmtree(self.directory)
+
+    def record(self, keys):
+        # Play the keys the way play_game() does: the key comes in first, then the turn is played with it.
+        # Returns the number of keys played
+        main.key = libtcod.Key()
+        played = 0
+        while played < keys and main.game_state == 'playing':
+            main.input_source.fill_key(main.key)
+            main.play_turn()
+            played += 1
+        main.stop_recording()
+        return played
+
+    def test_new_game(self):
+        main.recorder = Recorder(self.filename, main.game_seed)
+        played = self.record(50)
+        before = summary()
+        turns, seconds = replay.replay(self.filename)
+        self.assertEqual(turns, played)
+        self.assertEqual(summary(), before)
+
+    def test_level_up(self):
+        # the level up menu comes up in the first turn, before the key of that turn is used
+        main.player.fighter.xp = LEVEL_UP_BASE + main.player.level * LEVEL_UP_FACTOR
+        savegame = os.path.join(self.directory, 'savegame')
+        main.save_game(savegame)
+        main.recorder = Recorder(self.filename, main.game_seed, read(savegame), read(savegame + LEVEL_STORE_SUFFIX))
+        played = self.record(20)
+        before = summary()
+        self.assertEqual(main.player.level, 2)
+        turns, seconds = replay.replay(self.filename)
+        self.assertEqual(turns, played)
+        self.assertEqual(summary(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+"""Round trips through the savegame format: values, records and entities through Writer and Reader, and whole
+games through save_game() and load_game().
+
+Run from the repository root (libtcod is loaded from the working directory):
+
+    python -m unittest tests.test_savefile
+"""
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import libtcodpy as libtcod
+import main
+import savefile
+from autosave import Autosaver
+from benchmarks.savegame import game_summary
+from headless import ScriptedInput
+
+
+def double(x):
+    return 2 * x
+
+
+savefile.register_function(double, 'twice')  # an older name of the same function, savegames may still use it
+savefile.register_function(double)
+
+
+class Sample(savefile.Record):
+    # Stands in for a component whose fields change between versions of the game
+    __slots__ = ('a', 'b')
+    defaults = {'b': 7}
+
+    def __init__(self, a=None, b=None):
+        self.a = a
+        self.b = b
+
+
+class Thing(savefile.Record):
+    # An entity that can refer to other entities
+    __slots__ = ('name', 'friend')
+
+    def __init__(self, name, friend=None):
+        self.name = name
+        self.friend = friend
+
+
+savefile.register_class(Sample, ('a', 'b'))
+savefile.register_class(Thing, ('name', 'friend'), entity=True)
+
+
+def write(function):
+    # The bytes function(writer) writes after the header
+    f = io.BytesIO()
+    writer = savefile.Writer(f)
+    writer.header()
+    function(writer)
+    return f.getvalue()
+
+
+def reader(data):
+    r = savefile.Reader(io.BytesIO(data))
+    r.header()
+    return r
+
+
+class ValueTest(unittest.TestCase):
+
+    def round_trip(self, value):
+        return reader(write(lambda writer: writer.value(value))).value()
+
+    def test_plain_values(self):
+        for value in (None, True, False, 0, 1, -1, 127, 128, -129, 2 ** 40, -2 ** 40, 0.5, -1e100):
+            result = self.round_trip(value)
+            self.assertEqual(result, value)
+            self.assertEqual(type(result), type(value))
+
+    def test_strings(self):
+        # python 2 reads strings back as bytes
+        for value in (u'', u'orc', u'\xe9p\xe9e'):
+            result = self.round_trip(value)
+            if bytes is str:
+                result = result.decode('utf-8')
+            self.assertEqual(result, value)
+
+    def test_lists_and_tuples(self):
+        value = [1, (2, u'three', [None, (True,)]), [], ()]
+        self.assertEqual(self.round_trip(value), value)
+        self.assertIsInstance(self.round_trip((1, 2)), tuple)
+
+    def test_color(self):
+        color = self.round_trip(libtcod.Color(10, 20, 30))
+        self.assertEqual((color.r, color.g, color.b), (10, 20, 30))
+
+    def test_functions(self):
+        self.assertIs(self.round_trip(double), double)
+        data = write(lambda writer: (writer.value(double), writer.value(double), writer.value([double])))
+        r = reader(data)
+        self.assertEqual([r.value(), r.value(), r.value()], [double, double, [double]])
+
+    def test_function_under_another_name(self):
+        data = write(lambda writer: (writer.uint(savefile.FUNCTION), writer.name('twice')))
+        self.assertIs(reader(data).value(), double)
+
+    def test_unknown_function(self):
+        data = write(lambda writer: (writer.uint(savefile.FUNCTION), writer.name('no_such_function')))
+        self.assertRaises(savefile.SaveFormatError, reader(data).value)
+
+    def test_unsaveable_value(self):
+        self.assertRaises(savefile.SaveFormatError, write, lambda writer: writer.value(object()))
+
+    def test_bits(self):
+        plane = bytearray([1, 0, 0, 1, 1, 1, 0, 1, 0, 1, 1])
+        self.assertEqual(reader(write(lambda writer: writer.bits(plane))).bits(), plane)
+
+
+class HeaderTest(unittest.TestCase):
+
+    def test_version(self):
+        self.assertEqual(savefile.Reader(io.BytesIO(write(lambda writer: None))).header(), savefile.VERSION)
+
+    def test_older_version(self):
+        data = savefile.MAGIC + struct.pack('<H', savefile.MIN_VERSION)
+        self.assertEqual(savefile.Reader(io.BytesIO(data)).header(), savefile.MIN_VERSION)
+
+    def test_unsupported_versions(self):
+        for version in (savefile.MIN_VERSION - 1, savefile.VERSION + 1):
+            data = savefile.MAGIC + struct.pack('<H', version)
+            self.assertRaises(savefile.SaveFormatError, savefile.Reader(io.BytesIO(data)).header)
+
+    def test_not_a_savegame(self):
+        self.assertRaises(savefile.SaveFormatError, savefile.Reader(io.BytesIO(b'XXXX\x01\x00')).header)
+
+    def test_truncated(self):
+        data = write(lambda writer: writer.value([1, 2, 3]))
+        self.assertRaises(savefile.SaveFormatError, reader(data[:-1]).value)
+
+
+class RecordTest(unittest.TestCase):
+
+    def tearDown(self):
+        savefile.register_class(Sample, ('a', 'b'))
+
+    def test_record(self):
+        sample = reader(write(lambda writer: writer.value(Sample(1, [u'x', double])))).value()
+        self.assertIsInstance(sample, Sample)
+        self.assertEqual((sample.a, sample.b), (1, [u'x', double]))
+
+    def test_missing_field_gets_default(self):
+        # saved before the class had b
+        savefile.register_class(Sample, ('a',))
+        data = write(lambda writer: writer.value(Sample(1, 2)))
+        savefile.register_class(Sample, ('a', 'b'))
+        sample = reader(data).value()
+        self.assertEqual((sample.a, sample.b), (1, 7))
+
+    def test_field_no_longer_registered_is_skipped(self):
+        data = write(lambda writer: writer.value([Sample(1, 2), u'after']))
+        savefile.register_class(Sample, ('b',))
+        sample, after = reader(data).value()
+        self.assertEqual(sample.b, 2)
+        self.assertFalse(hasattr(sample, 'a'))
+        self.assertEqual(after, u'after')
+
+    def test_unknown_class(self):
+        data = write(lambda writer: writer.value(Sample(1, 2)))
+        del savefile._classes['Sample']
+        try:
+            self.assertRaises(savefile.SaveFormatError, reader(data).value)
+        finally:
+            savefile.register_class(Sample, ('a', 'b'))
+
+    def test_game_components(self):
+        fighter = main.Fighter(hp=20, defense=1, power=4, xp=25, death_function=main.monster_death)
+        fighter.active_effects = [main.Effect('berserk', 3, power_mod=2)]
+        copy = reader(write(lambda writer: writer.value(fighter))).value()
+        self.assertEqual((copy.base_max_hp, copy.hp, copy.base_defense, copy.base_power, copy.xp),
+                         (20, 20, 1, 4, 25))
+        self.assertIs(copy.death_function, main.monster_death)
+        self.assertEqual([(e.name, e.duration, e.power_mod) for e in copy.active_effects], [('berserk', 3, 2)])
+
+
+class EntityTest(unittest.TestCase):
+
+    def test_references_are_kept(self):
+        a = Thing(u'a')
+        b = Thing(u'b', a)
+        a.friend = b
+
+        def write_all(writer):
+            writer.entities([a, b])
+            writer.value([b, a])
+        r = reader(write(write_all))
+        loaded_a, loaded_b = r.read_entities()
+        self.assertIs(loaded_a.friend, loaded_b)
+        self.assertIs(loaded_b.friend, loaded_a)
+        self.assertEqual(r.value(), [loaded_b, loaded_a])
+
+    def test_entity_outside_the_table(self):
+        outsider = Thing(u'outsider')
+        self.assertRaises(savefile.SaveFormatError, write,
+                          lambda writer: writer.entities([Thing(u'a', outsider)]))
+
+    def test_snapshot(self):
+        a = Thing(u'a')
+        b = Thing(u'b', a)
+        (copy_a, copy_b), (values,) = savefile.snapshot([a, b], [[b]])
+        self.assertIsNot(copy_a, a)
+        self.assertIs(copy_b.friend, copy_a)
+        self.assertIs(values[0], copy_b)
+
+
+class GameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'savegame')
+        main.init_headless(ScriptedInput('wasdqezc', repeat=True))
+        main.mouse = libtcod.Mouse()
+        main.new_game(1)
+
+    def tearDown(self):
+        main.open_level_store(None)  # the store in the directory is closed before it goes
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        main.play_headless(main.input_source, 100)
+        before = game_summary()
+        main.save_game(self.filename)
+        main.new_game(2)
+        main.load_game(self.filename)
+        self.assertEqual(game_summary(), before)
+
+    def test_snapshot_does_not_change_with_the_game(self):
+        # what an autosave writes is the game as it was when the snapshot was taken
+        main.play_headless(main.input_source, 20)
+        main.write_savegame(main.snapshot_game(), self.filename)  # the chunks are shared with this one
+        snapshot = main.snapshot_game()
+        before = game_summary()
+        main.world_map.carve(0, 0, main.world_map.width - 1, main.world_map.height - 1)
+        main.world_map.set('explored', 0, 0, True)
+        main.write_savegame(snapshot, self.filename)
+        main.new_game(2)
+        main.load_game(self.filename)
+        self.assertEqual(game_summary(), before)
+
+    def test_autosave_keeps_the_levels(self):
+        main.autosaver = Autosaver(main.write_savegame, self.filename)
+        try:
+            main.player.x, main.player.y = main.stairs.x, main.stairs.y
+            level_one = game_summary()[5:]
+            main.next_level()  # autosaves
+            before = game_summary()
+        finally:
+            main.autosaver.close()
+            main.autosaver = None
+        main.new_game(2)
+        main.load_game(self.filename)
+        self.assertEqual(game_summary(), before)
+        main.player.x, main.player.y = main.upstairs.x, main.upstairs.y
+        main.previous_level()
+        self.assertEqual(game_summary()[5:], level_one)
+
+    def test_levels_left_are_kept(self):
+        main.player.x, main.player.y = main.stairs.x, main.stairs.y
+        level_one = game_summary()[5:]
+        main.next_level()
+        main.save_game(self.filename)
+        before = game_summary()
+        main.new_game(2)
+        main.load_game(self.filename)
+        self.assertEqual(game_summary(), before)
+        main.player.x, main.player.y = main.upstairs.x, main.upstairs.y
+        main.previous_level()
+        self.assertEqual(game_summary()[5:], level_one)
+
+
+if __name__ == '__main__':
+    unittest.main()
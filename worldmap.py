@@ -0,0 +1,299 @@
+import binascii
+
+try:  # NumPy is optional, it is only used to speed things up
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+from constants import CHUNK_SIZE
+
+PLANES = ('blocked', 'block_sight', 'explored')
+
+
+class Chunk(object):
+    """CHUNK_SIZE x CHUNK_SIZE tiles of a map, one byte plane per tile property indexed row by row"""
+    __slots__ = PLANES
+
+    def __init__(self, size, defaults):
+        for plane in PLANES:
+            setattr(self, plane, bytearray([defaults[plane]]) * (size * size))
+
+    def freeze(self):
+        # A copy that can't change, with the planes as bytes
+        copy = Chunk.__new__(Chunk)
+        for plane in PLANES:
+            setattr(copy, plane, bytes(getattr(self, plane)))
+        return copy
+
+
+class WorldMap(object):
+    """The tiles of a level, stored in square chunks with one byte plane per tile property.
+
+    A chunk is only allocated when a tile in it changes, until then all of it's tiles have the defaults (solid
+    rock, or open floor, and unexplored). A level much larger than the screen only takes memory for the parts
+    that were dug out or seen. region() copies any rectangle of a plane out row by row, the same order the
+    console fill functions and libtcod maps use.
+    world_map[x][y] returns a Tile view so code can keep using world_map[x][y].blocked and friends."""
+
+    def __init__(self, width, height, blocked=True, chunk_size=CHUNK_SIZE):
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        fill = 1 if blocked else 0
+        # by default, if a tile is blocked it also blocks sight
+        self.defaults = {'blocked': fill, 'block_sight': fill, 'explored': 0}
+        self.chunks = {}  # (chunk x, chunk y) -> Chunk
+        self.frozen = {}  # (chunk x, chunk y) -> frozen copy of the chunk as it is now, see snapshot()
+        self.version = 0  # goes up whenever walls are added or removed
+
+    def __len__(self):
+        return self.width
+
+    def __getitem__(self, x):
+        if not 0 <= x < self.width:
+            raise IndexError('map column out of range')
+        return _Column(self, x)
+
+    def chunk(self, cx, cy):
+        # The chunk, allocated if it wasn't yet. Everything that changes tiles gets their chunk from here, so it's
+        # frozen copy is out of date from now on
+        self.frozen.pop((cx, cy), None)
+        chunk = self.chunks.get((cx, cy))
+        if chunk is None:
+            chunk = self.chunks[(cx, cy)] = Chunk(self.chunk_size, self.defaults)
+        return chunk
+
+    def snapshot(self):
+        # A copy of the map that doesn't change with it, to be written out while the game goes on. Only the chunks
+        # changed since the last snapshot are copied, the others share the copy made back then
+        copy = WorldMap(self.width, self.height, self.defaults['blocked'] != 0, self.chunk_size)
+        for key, chunk in self.chunks.items():
+            frozen = self.frozen.get(key)
+            if frozen is None:
+                frozen = self.frozen[key] = chunk.freeze()
+            copy.chunks[key] = frozen
+        return copy
+
+    def get(self, plane, x, y):
+        size = self.chunk_size
+        chunk = self.chunks.get((x // size, y // size))
+        if chunk is None:
+            return self.defaults[plane]
+        return getattr(chunk, plane)[(y % size) * size + x % size]
+
+    def set(self, plane, x, y, value):
+        size = self.chunk_size
+        getattr(self.chunk(x // size, y // size), plane)[(y % size) * size + x % size] = 1 if value else 0
+        if plane != 'explored':
+            self.version += 1
+
+    def is_blocked(self, x, y):
+        size = self.chunk_size
+        chunk = self.chunks.get((x // size, y // size))
+        if chunk is None:
+            return self.defaults['blocked'] != 0
+        return chunk.blocked[(y % size) * size + x % size] != 0
+
+    def _spans(self, x1, y1, x2, y2):
+        # The parts of the inclusive rectangle in each chunk: (cx, cy, x, y, width, height) with x and y
+        # relative to the chunk
+        size = self.chunk_size
+        for cy in range(y1 // size, y2 // size + 1):
+            top = max(y1, cy * size)
+            bottom = min(y2, cy * size + size - 1)
+            for cx in range(x1 // size, x2 // size + 1):
+                left = max(x1, cx * size)
+                right = min(x2, cx * size + size - 1)
+                yield cx, cy, left - cx * size, top - cy * size, right - left + 1, bottom - top + 1
+
+    def carve(self, x1, y1, x2, y2):
+        # Make every tile in the inclusive rectangle walkable and transparent, the part in each chunk with one 2d
+        # slice (NumPy) or one slice per row. A single row (most of a corridor) is one slice anyway, and cheaper
+        # without going through NumPy
+        size = self.chunk_size
+        for (cx, cy, x, y, w, h) in self._spans(x1, y1, x2, y2):
+            chunk = self.chunk(cx, cy)
+            if numpy_available and h > 1:
+                _grid(chunk.blocked, size)[y:y + h, x:x + w] = 0
+                _grid(chunk.block_sight, size)[y:y + h, x:x + w] = 0
+                continue
+            floor = bytearray(w)
+            for row in range(y, y + h):
+                start = row * size + x
+                chunk.blocked[start:start + w] = floor
+                chunk.block_sight[start:start + w] = floor
+        self.version += 1
+
+    def carve_corridor(self, x1, y1, x2, y2, horizontal_first):
+        # An L-shaped corridor from (x1, y1) to (x2, y2), turning at (x2, y1) or at (x1, y2)
+        if horizontal_first:
+            self.carve(min(x1, x2), y1, max(x1, x2), y1)
+            self.carve(x2, min(y1, y2), x2, max(y1, y2))
+        else:
+            self.carve(x1, min(y1, y2), x1, max(y1, y2))
+            self.carve(min(x1, x2), y2, max(x1, x2), y2)
+
+    def region(self, plane, x1, y1, width, height):
+        # A copy of a rectangle of the plane, row by row. Missing chunks read as the defaults
+        size = self.chunk_size
+        data = bytearray([self.defaults[plane]]) * (width * height)
+        for (cx, cy, x, y, w, h) in self._spans(x1, y1, x1 + width - 1, y1 + height - 1):
+            chunk = self.chunks.get((cx, cy))
+            if chunk is None:
+                continue
+            source = getattr(chunk, plane)
+            for row in range(h):
+                start = (cy * size + y + row - y1) * width + cx * size + x - x1
+                data[start:start + w] = source[(y + row) * size + x:(y + row) * size + x + w]
+        return data
+
+    def set_region(self, plane, x1, y1, width, height, data):
+        # Write a rectangle of the plane from row by row data. Chunks the data leaves at the defaults stay
+        # unallocated
+        size = self.chunk_size
+        untouched = bytearray([self.defaults[plane]]) * size
+        for (cx, cy, x, y, w, h) in self._spans(x1, y1, x1 + width - 1, y1 + height - 1):
+            rows = []
+            for row in range(h):
+                start = (cy * size + y + row - y1) * width + cx * size + x - x1
+                rows.append(data[start:start + w])
+            if (cx, cy) not in self.chunks and all(row == untouched[:w] for row in rows):
+                continue
+            target = getattr(self.chunk(cx, cy), plane)
+            for row, values in enumerate(rows):
+                target[(y + row) * size + x:(y + row) * size + x + w] = values
+        if plane != 'explored':
+            self.version += 1
+
+    def explore(self, x1, y1, width, height, cells, bit):
+        # Mark the tiles of the rectangle whose cell (row by row, like region()) has the bit set as explored, the
+        # lit part of each chunk in one go. Chunks with nothing lit are left alone
+        size = self.chunk_size
+        if numpy_available:
+            lit = ((numpy.frombuffer(cells, dtype=numpy.uint8) & bit) != 0).reshape(height, width)
+        else:
+            lit_table = bytearray(1 if value & bit else 0 for value in range(256))
+        for (cx, cy, x, y, w, h) in self._spans(x1, y1, x1 + width - 1, y1 + height - 1):
+            left = cx * size + x - x1
+            top = cy * size + y - y1
+            if numpy_available:
+                block = lit[top:top + h, left:left + w]
+                if block.any():
+                    _grid(self.chunk(cx, cy).explored, size)[y:y + h, x:x + w] |= block
+                continue
+            for row in range(h):
+                start = (top + row) * width + left
+                seen = bytearray(cells[start:start + w]).translate(lit_table)
+                if b'\x01' in seen:
+                    explored = self.chunk(cx, cy).explored
+                    target = (y + row) * size + x
+                    explored[target:target + w] = _or_bytes(explored[target:target + w], seen)
+
+    def plane(self, plane):
+        # The whole plane, row by row (y * width + x)
+        return self.region(plane, 0, 0, self.width, self.height)
+
+    def load_plane(self, plane, data):
+        self.set_region(plane, 0, 0, self.width, self.height, bytearray(data))
+
+    def fov_cells(self, x, y, width, height):
+        # The cells of a libtcod fov map covering the rectangle (see libtcod.map_set_cells): transparent and
+        # walkable bits
+        block_sight = self.region('block_sight', x, y, width, height)
+        blocked = self.region('blocked', x, y, width, height)
+        if numpy_available:
+            return ((numpy.frombuffer(block_sight, dtype=numpy.uint8) == 0).astype(numpy.uint8) |
+                    (numpy.frombuffer(blocked, dtype=numpy.uint8) == 0).astype(numpy.uint8) << 1).tobytes()
+        return bytearray((not sight) | (not wall) << 1 for sight, wall in zip(block_sight, blocked))
+
+    def __getstate__(self):
+        return {'width': self.width, 'height': self.height,
+                'planes': [bytes(self.plane(plane)) for plane in PLANES]}
+
+    def __setstate__(self, state):
+        self.__init__(state['width'], state['height'])
+        for plane, data in zip(PLANES, state['planes']):
+            self.load_plane(plane, data)
+        self.version = 0
+
+
+def _grid(plane, size):
+    # A chunk's plane as a size x size NumPy array, writing to it writes to the plane
+    return numpy.frombuffer(plane, dtype=numpy.uint8).reshape(size, size)
+
+
+def _or_bytes(a, b):
+    # a | b byte by byte, as two big numbers so it doesn't loop in python
+    n = int(binascii.hexlify(a), 16) | int(binascii.hexlify(b), 16)
+    return bytearray(binascii.unhexlify('%0*x' % (2 * len(a), n)))
+
+
+class RoomMask(object):
+    """The tiles taken by the rooms of a level being generated, including their walls.
+
+    A new room is tested against all the rooms so far at once, by looking for a taken tile in it's rectangle
+    (a 2d slice with NumPy, a search per row without), instead of comparing it with every room in turn."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.mask = bytearray(width * height)
+        self.array = None
+        if numpy_available:
+            self.array = numpy.frombuffer(self.mask, dtype=numpy.bool_).reshape(height, width)
+
+    def overlaps(self, x1, y1, x2, y2):
+        # True if any tile of the inclusive rectangle is taken
+        if self.array is not None:
+            return bool(self.array[y1:y2 + 1, x1:x2 + 1].any())
+        for y in range(y1, y2 + 1):
+            start = y * self.width + x1
+            if self.mask.find(b'\x01', start, start + x2 - x1 + 1) != -1:
+                return True
+        return False
+
+    def add(self, x1, y1, x2, y2):
+        if self.array is not None:
+            self.array[y1:y2 + 1, x1:x2 + 1] = True
+            return
+        taken = bytearray(b'\x01') * (x2 - x1 + 1)
+        for y in range(y1, y2 + 1):
+            start = y * self.width + x1
+            self.mask[start:start + len(taken)] = taken
+
+
+class _Column(object):
+    __slots__ = ('world_map', 'x')
+
+    def __init__(self, world_map, x):
+        self.world_map = world_map
+        self.x = x
+
+    def __len__(self):
+        return self.world_map.height
+
+    def __getitem__(self, y):
+        if not 0 <= y < self.world_map.height:
+            raise IndexError('map row out of range')
+        return Tile(self.world_map, self.x, y)
+
+
+class Tile(object):
+    """A view of one tile of a WorldMap and it's properties"""
+    __slots__ = ('world_map', 'x', 'y')
+
+    def __init__(self, world_map, x, y):
+        self.world_map = world_map
+        self.x = x
+        self.y = y
+
+    def _get(plane):
+        return lambda self: self.world_map.get(plane, self.x, self.y) != 0
+
+    def _set(plane):
+        return lambda self, value: self.world_map.set(plane, self.x, self.y, value)
+
+    blocked = property(_get('blocked'), _set('blocked'))
+    block_sight = property(_get('block_sight'), _set('block_sight'))
+    explored = property(_get('explored'), _set('explored'))
+    del _get, _set